@@ -1,6 +1,11 @@
 from typing import List, Tuple
 from PIL import Image
 from itertools import product
+from os import path
+from math import ceil, floor
+import numpy as np
+import random
+import json
 
 
 def get_luminance(rgb):
@@ -20,6 +25,17 @@ def get_contrast(c1, c2):
     return contrast
 
 
+def get_luminances(colors):
+    # Vectorized get_luminance, colors is a [N, 3] array
+    colors = np.asarray(colors, dtype=np.float64)
+    return colors[..., :3] @ np.array([0.2126, 0.72152, 0.0722]) / 255
+
+
+def get_contrasts(l1, l2):
+    # Vectorized get_contrast, on broadcastable luminance arrays
+    return (np.maximum(l1, l2) + 0.05) / (np.minimum(l1, l2) + 0.05)
+
+
 def get_dominance_colors(image, num_colors):
     image = image.copy()
     q_image = image.quantize(num_colors).convert("RGB")
@@ -37,15 +53,157 @@ def safe_tqdm(iterable, *a, **k):
         return iterable
 
 
+def image_key(image):
+    # Identify images loaded from files by their path, mtime and size
+    filename = getattr(image, "filename", "")
+    if not filename or not path.isfile(filename):
+        return None
+    mtime = path.getmtime(filename)
+    return f"{path.abspath(filename)}:{mtime}:{image.size}"
+
+
+class LuminanceTable:
+    """
+    Summed-area tables of an image luminance and squared luminance,
+    so that the mean and variance of any box are looked up in O(1).
+
+    The tables are built on a copy downscaled to fit `max_size`,
+    boxes are given in the original image coordinates. Only the
+    uint8 luminance is saved, the tables are rebuilt on load.
+    """
+
+    def __init__(self, luminance, scale):
+        self.luminance = luminance
+        self.scale = scale
+        values = luminance / 255
+        height, width = luminance.shape
+        self.table = np.zeros((height + 1, width + 1, 2))
+        self.table[1:, 1:, 0] = values.cumsum(axis=0).cumsum(axis=1)
+        self.table[1:, 1:, 1] = (values ** 2).cumsum(axis=0).cumsum(axis=1)
+
+    @classmethod
+    def from_image(cls, image, max_size=256):
+        width, height = image.size
+        scale = max(1, width / max_size, height / max_size)
+        size = (ceil(width / scale), ceil(height / scale))
+        small = image.convert("RGB").resize(size, Image.Resampling.BOX)
+        luminance = get_luminances(np.asarray(small))
+        return cls(np.round(luminance * 255).astype(np.uint8), scale)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            return cls(data["luminance"], float(data["scale"]))
+
+    def save(self, file):
+        np.savez_compressed(file, luminance=self.luminance, scale=self.scale)
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes + self.luminance.nbytes
+
+    def stats(self, box):
+        # Mean and variance of the luminance inside box
+        x1, y1, x2, y2 = box
+        height, width, _ = self.table.shape
+        x1 = min(floor(x1 / self.scale), width - 2)
+        y1 = min(floor(y1 / self.scale), height - 2)
+        x2 = max(min(ceil(x2 / self.scale), width - 1), x1 + 1)
+        y2 = max(min(ceil(y2 / self.scale), height - 1), y1 + 1)
+        t = self.table
+        total, sq_total = t[y2, x2] - t[y1, x2] - t[y2, x1] + t[y1, x1]
+        area = (x2 - x1) * (y2 - y1)
+        mean = total / area
+        return mean, max(sq_total / area - mean ** 2, 0)
+
+    def mean(self, box):
+        return self.stats(box)[0]
+
+    def variance(self, box):
+        return self.stats(box)[1]
+
+
+class PaletteIndex:
+    """
+    Dominant colors of background images.
+
+    Images loaded from files are keyed by path, mtime and size,
+    and the index can be saved to `file` so that next runs
+    do not have to quantize the same backgrounds again.
+    `pop_new()` gives the palettes computed since its last call,
+    for processes to send them to the one that saves the index.
+    """
+
+    def __init__(self, file=None, num_colors=3):
+        self.file = file
+        self.num_colors = num_colors
+        self.palettes = {}
+        self.new = {}
+        if file is not None and path.isfile(file):
+            with open(file) as f:
+                self.palettes = json.load(f)
+
+    def key(self, image):
+        key = image_key(image)
+        return None if key is None else f"{key}:{self.num_colors}"
+
+    def get(self, image):
+        key = self.key(image)
+        palette = self.palettes.get(key, None)
+        if palette is None:
+            palette = sorted(get_dominance_colors(image, self.num_colors))
+            if key is not None:
+                self.palettes[key] = palette
+                self.new[key] = palette
+        return np.array(palette)
+
+    def pop_new(self):
+        new, self.new = self.new, {}
+        return new
+
+    def update(self, palettes):
+        self.palettes.update(palettes)
+
+    def save(self):
+        if self.file is not None:
+            with open(self.file, "w") as f:
+                json.dump(self.palettes, f)
+
+
+class ContrastColorSampler:
+    """
+    Pick a text color with enough contrast against a given background,
+    without precomputing every (background, color) pairing.
+    """
+
+    def __init__(self, colors, palette_index=None, contrast_threshold: float = 3):
+        self.colors = [tuple(color) for color in colors]
+        self.luminances = get_luminances(self.colors)
+        self.palette_index = palette_index or PaletteIndex()
+        self.contrast_threshold = contrast_threshold
+
+    def get_valid_colors(self, background):
+        bg = get_luminances(self.palette_index.get(background))
+        contrasts = get_contrasts(bg[:, None], self.luminances[None, :])
+        return np.flatnonzero(contrasts.min(axis=0) >= self.contrast_threshold)
+
+    def sample(self, background, rng=random):
+        # None if no color is readable on this background
+        valid = self.get_valid_colors(background)
+        if len(valid) == 0:
+            return None
+        return self.colors[rng.choice(valid)]
+
+
 def get_bg_fg_pairings(backgrounds: List[Image.Image],
                        colors: List[Tuple[int, int, int]],
                        num_colors: int = 3,
-                       contrast_threshold: float = 3):
+                       contrast_threshold: float = 3,
+                       palette_index: PaletteIndex = None):
+    palette_index = palette_index or PaletteIndex(num_colors=num_colors)
+    sampler = ContrastColorSampler(colors, palette_index, contrast_threshold)
     pairings = []
     for background in safe_tqdm(backgrounds, "Pairing bg and fg colors"):
-        palettes = get_dominance_colors(background, num_colors)
-        for fg in colors:
-            min_contrast = min(get_contrast(bg, fg) for bg in palettes)
-            if min_contrast >= contrast_threshold:
-                pairings.append((background, fg))
+        for i in sampler.get_valid_colors(background):
+            pairings.append((background, sampler.colors[i]))
     return pairings
@@ -0,0 +1,119 @@
+from fontTools.ttLib import TTFont
+from os import path
+from io import BytesIO
+import numpy as np
+
+from .writers import write_atomic
+
+
+def read_cmap(file):
+    # Sorted codepoints of every cmap table of the (first) font
+    codepoints = set()
+    try:
+        with TTFont(file, lazy=True, fontNumber=0) as font:
+            for table in font["cmap"].tables:
+                codepoints.update(table.cmap.keys())
+    except Exception:
+        print(f"Can't read {file}")
+    return np.array(sorted(codepoints), dtype=np.uint32)
+
+
+def get_mtime(file):
+    return path.getmtime(file) if path.isfile(file) else 0
+
+
+class CoverageIndex:
+    """
+    Codepoints covered by each font file, read from their cmap tables.
+
+    If `file` is given, the codepoints are saved there and only new
+    or modified fonts are read on the next runs. `covering(text)` is a
+    bitmask of the fonts having every character of `text`, made of
+    one bitmask per codepoint so that a lookup is a few `&`.
+    """
+
+    def __init__(self, fonts, file=None):
+        self.fonts = [path.abspath(font) for font in fonts]
+        self.file = file
+        self.all_fonts = (1 << len(self.fonts)) - 1
+        self.masks = {}
+
+        saved = self.load()
+        mtimes = [get_mtime(font) for font in self.fonts]
+        self.codepoints = []
+        changed = False
+        for font, mtime in zip(self.fonts, mtimes):
+            codepoints = saved.get((font, mtime), None)
+            if codepoints is None:
+                codepoints = read_cmap(font)
+                changed = True
+            self.codepoints.append(codepoints)
+        if changed:
+            self.save(mtimes)
+
+        # Fonts of each codepoint, sorted by codepoint
+        font_ids = [np.full(len(c), i, dtype=np.int64)
+                    for i, c in enumerate(self.codepoints)]
+        all_codepoints = np.concatenate(self.codepoints + [np.zeros(0, np.uint32)])
+        order = np.argsort(all_codepoints, kind="stable")
+        self.sorted_codepoints = all_codepoints[order]
+        self.sorted_fonts = np.concatenate(font_ids + [np.zeros(0, np.int64)])[order]
+
+    def load(self):
+        if self.file is None or not path.isfile(self.file):
+            return {}
+        with np.load(self.file) as data:
+            fonts, mtimes = data["fonts"].tolist(), data["mtimes"].tolist()
+            offsets, codepoints = data["offsets"], data["codepoints"]
+        return {(font, mtime): codepoints[offsets[i]:offsets[i + 1]]
+                for i, (font, mtime) in enumerate(zip(fonts, mtimes))}
+
+    def save(self, mtimes):
+        if self.file is None:
+            return
+        offsets = np.cumsum([0] + [len(c) for c in self.codepoints], dtype=np.uint64)
+        io = BytesIO()
+        np.savez(io,
+                 fonts=np.array(self.fonts, dtype=str),
+                 mtimes=np.array(mtimes, dtype=np.float64),
+                 offsets=offsets,
+                 codepoints=np.concatenate(self.codepoints + [np.zeros(0, np.uint32)]))
+        write_atomic(self.file, io.getvalue())
+
+    def __len__(self):
+        return len(self.fonts)
+
+    def get_mask(self, codepoint):
+        mask = self.masks.get(codepoint, None)
+        if mask is None:
+            lo = np.searchsorted(self.sorted_codepoints, codepoint, "left")
+            hi = np.searchsorted(self.sorted_codepoints, codepoint, "right")
+            ids = self.sorted_fonts[lo:hi]
+            bits = np.zeros((len(self.fonts) + 7) // 8, dtype=np.uint8)
+            np.bitwise_or.at(bits, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+            mask = self.masks[codepoint] = int.from_bytes(bits.tobytes(), "little")
+        return mask
+
+    def covering(self, text):
+        # Whitespaces are blank with or without a glyph
+        mask = self.all_fonts
+        for char in set(text):
+            if not char.isspace():
+                mask &= self.get_mask(ord(char))
+                if mask == 0:
+                    break
+        return mask
+
+    def missing(self, i, text):
+        # Characters of `text` that the i-th font does not have
+        codepoints = self.codepoints[i]
+        chars = list(dict.fromkeys(text))
+        found = np.isin([ord(c) for c in chars], codepoints)
+        return [c for c, f in zip(chars, found) if not f]
+
+
+def mask_indices(mask):
+    # Indices of the set bits
+    bits = np.frombuffer(mask.to_bytes((mask.bit_length() + 7) // 8, "little"),
+                         dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(bits, bitorder="little"))
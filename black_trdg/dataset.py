@@ -0,0 +1,67 @@
+class GeneratorIterable:
+    """
+    Iterate over the samples of a Generator, split between workers.
+
+    The index ranges of `generator.chunks()` are dealt to the
+    `world_size` processes, then to the loader workers of each of
+    them. Samples only depend on their index, so they do not
+    depend on the number of workers. Use `set_epoch` to get new
+    samples every epoch.
+
+    For PyTorch's DataLoader, use `GeneratorDataset`, the same
+    class as a `torch.utils.data.IterableDataset`.
+    """
+
+    def __init__(self, generator, transform=None, rank=0, world_size=1):
+        self.generator = generator
+        self.transform = transform
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_worker_info(self):
+        # Worker id and number of workers
+        return 0, 1
+
+    def get_chunks(self):
+        chunks = self.generator.chunks()
+        return chunks[self.rank::self.world_size]
+
+    def __len__(self):
+        return sum(stop - start for start, stop in self.get_chunks())
+
+    def __iter__(self):
+        worker_id, num_workers = self.get_worker_info()
+        offset = self.epoch * len(self.generator)
+        for start, stop in self.get_chunks()[worker_id::num_workers]:
+            samples = self.generator.generate_range(start + offset, stop + offset)
+            for _, image, text in samples:
+                if self.transform is not None:
+                    image = self.transform(image)
+                yield image, text
+
+
+def _get_torch_worker_info(self):
+    from torch.utils.data import get_worker_info
+    info = get_worker_info()
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+def __getattr__(name):
+    # GeneratorDataset is only created when it is used,
+    # so that importing this module does not import torch
+    if name == "GeneratorDataset":
+        from torch.utils.data import IterableDataset
+        GeneratorDataset = type(name, (GeneratorIterable, IterableDataset), {
+            "__module__": __name__,
+            "__doc__": GeneratorIterable.__doc__,
+            "get_worker_info": _get_torch_worker_info,
+        })
+        globals()[name] = GeneratorDataset
+        return GeneratorDataset
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
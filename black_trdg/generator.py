@@ -1,10 +1,74 @@
 from PIL import ImageFont, Image, ImageDraw
 from typing import Tuple, Optional, Callable
-from random import randint
 from os import path, listdir
+from functools import partial, cached_property
+from contextlib import contextmanager
+from operator import attrgetter
+import numpy as np
 import random
+import cv2
 
-from .colors import get_bg_fg_pairings
+from .colors import (get_bg_fg_pairings, PaletteIndex, ContrastColorSampler,
+                     LuminanceTable, image_key, get_contrast, get_luminance)
+from .lru import ByteLRU, image_nbytes, unit_size
+from .samplers.base import draw, find_table, iter_samplers
+from .samplers.other import FontPool
+from .transforms import call_transform, PadToAspect, RandomApply
+
+
+def font_id(font):
+    # Fonts loaded from the same file at the same size render the same
+    path = getattr(font, "path", None)
+    if not isinstance(path, (str, bytes)):
+        path = id(font)
+    return (path, getattr(font, "index", 0), getattr(font, "size", None))
+
+
+def mask_size(text, font, stroke_width=0):
+    # Size of the mask `render_mask` makes, without rendering
+    x1, y1, x2, y2 = font.getbbox(text, stroke_width=stroke_width)
+    return x2 - x1, y2 - x1
+
+
+def render_mask(text, font, stroke_width=0):
+    # Text coverage only, the color is applied later by `tint`
+    crop_width, crop_height = mask_size(text, font, stroke_width)
+    mask = Image.new("L", (crop_width, crop_height), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.text((0, 0), text, font=font, fill=255, stroke_width=stroke_width)
+    return mask
+
+
+def tint(mask, color):
+    alpha = np.asarray(mask)
+    rgba = np.empty(alpha.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = color[:3]
+    rgba[..., 3] = alpha
+    return Image.fromarray(rgba, "RGBA")
+
+
+def blend(background, mask, color):
+    # Paint `color` over the background through the coverage mask,
+    # in uint16 so that bg * (255 - a) + color * a can not overflow
+    bg = np.asarray(background.convert("RGB"), dtype=np.uint16)
+    alpha = np.asarray(mask, dtype=np.uint16)[..., None]
+    color = np.array(color[:3], dtype=np.uint16)
+    output = (bg * (255 - alpha) + color * alpha + 127) // 255
+    return Image.fromarray(output.astype(np.uint8), "RGB")
+
+
+class TextMaskCache(ByteLRU):
+    """
+    LRU cache of rendered text masks, keyed by (font, text, stroke width).
+    The masks are single channel, the total size is bounded by `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        super().__init__(max_bytes, image_nbytes)
+
+    def get(self, text, font, stroke_width=0):
+        key = (font_id(font), text, stroke_width)
+        return super().get(key, lambda: render_mask(text, font, stroke_width))
 
 
 def generate(
@@ -15,6 +79,11 @@ def generate(
     stroke_width: int = 0,
     transform: Optional[Callable] = None,
     background_transform: Optional[Callable] = None,
+    cache: Optional[TextMaskCache] = None,
+    render_mode: str = "rgba",
+    crop_check: Optional[Callable] = None,
+    crop_tries: int = 1,
+    rng=random,
 ):
     """
     - Load the font, use a big font size so that the image is not broken
@@ -24,40 +93,60 @@ def generate(
     - Distortion, affine transform, etc... [TODO]
     - Resize to desired size
     - Returns both image and text
-    """
-    # Estimate the text bounding box
-    x1, y1, x2, y2 = font.getbbox(text, stroke_width=stroke_width)
-    crop_width, crop_height = x2 - x1, y2 - x1
 
-    # Create the empty text box
-    text_mask = Image.new("RGBA", (crop_width, crop_height), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(text_mask)
-    draw.font = font
-    draw.text((0, 0), text, font=font, fill=text_color)
+    With `render_mode="mask"`, only the text coverage mask goes through
+    `transform` and the color is blended into the background at the end,
+    instead of transforming and compositing a full RGBA text image.
+
+    If `crop_check(background, crop_box)` is given, up to `crop_tries`
+    crop positions are tried, None is returned if all of them fail.
+
+    All the random draws, including the transforms', come from `rng`.
+    """
+    # Render the text box, or reuse a rendered one
+    if cache is not None:
+        mask = cache.get(text, font, stroke_width)
+    else:
+        mask = render_mask(text, font, stroke_width)
+    if render_mode == "rgba":
+        text_mask = tint(mask, text_color)
+    else:
+        text_mask = mask
 
     # Apply transformation(s) if any
     if transform is not None:
-        text_mask = transform(text_mask)
+        text_mask = call_transform(transform, text_mask, rng)
 
     # Get the real crop size and get the cropped background
     crop_width, crop_height = text_mask.size
     bg_width, bg_height = background.size
     if bg_width <= crop_width or bg_height <= crop_height:
+        crop_box = (0, 0, bg_width, bg_height)
+        if crop_check is not None and not crop_check(background, crop_box):
+            return None
         background = background.resize((crop_width, crop_height))
     else:
-        crop_x1 = randint(0, bg_width - crop_width - 1)
-        crop_y1 = randint(0, bg_height - crop_height - 1)
-        crop_box = (crop_x1,
-                    crop_y1,
-                    crop_x1 + crop_width,
-                    crop_y1 + crop_height)
+        for _ in range(crop_tries):
+            crop_x1 = rng.randint(0, bg_width - crop_width - 1)
+            crop_y1 = rng.randint(0, bg_height - crop_height - 1)
+            crop_box = (crop_x1,
+                        crop_y1,
+                        crop_x1 + crop_width,
+                        crop_y1 + crop_height)
+            if crop_check is None or crop_check(background, crop_box):
+                break
+        else:
+            return None
         background = background.crop(crop_box)
     if background_transform is not None:
-        background = background_transform(background)
+        background = call_transform(background_transform, background, rng)
 
     # Composite fg and bg
-    output = Image.alpha_composite(background.convert("RGBA"), text_mask)
-    output = output.convert("RGB")  # To write JPG
+    if render_mode == "rgba":
+        output = Image.alpha_composite(background.convert("RGBA"), text_mask)
+        output = output.convert("RGB")  # To write JPG
+    else:
+        output = blend(background, text_mask, text_color)
 
     return output
 
@@ -78,6 +167,36 @@ def prepare_assets(asset: str, load_function):
         raise ValueError("invalid asset")
 
 
+class SampleRandom(random.Random):
+    """
+    Random numbers of the sample at `index`, a pure function of
+    (seed, index): the state is derived by `SeedSequence(seed,
+    spawn_key=(index,))`, independently of any other sample.
+    `self.np` is a NumPy Philox generator keyed the same way, for
+    the NumPy draws (see `samplers.base.numpy_rng`).
+    """
+
+    def __init__(self, seed, index):
+        self.seed_sequence = np.random.SeedSequence(seed, spawn_key=(index,))
+        state = self.seed_sequence.generate_state(4, np.uint64)
+        super().__init__(int.from_bytes(state.tobytes(), "little"))
+
+    @cached_property
+    def np(self):
+        return np.random.Generator(np.random.Philox(self.seed_sequence))
+
+
+@contextmanager
+def seeded(seed):
+    # Seed the random module for a block, and put its state back after
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+
 def load_textfile(textfile):
     with open(textfile) as f:
         return [line.strip() for line in f.readlines()]
@@ -92,44 +211,416 @@ class Generator(tuple):
                  transform=None,
                  background_transform=None,
                  count=None,
-                 seed=None):
+                 seed=None,
+                 chunk_size=1000,
+                 text_cache_bytes=64 * 2**20,
+                 render_mode="rgba",
+                 color_pairing="sample",
+                 palette_file=None,
+                 crop_contrast=None,
+                 crop_tries=5,
+                 font_coverage=True,
+                 bucket_height=None,
+                 bucket_widths=None,
+                 bucket_min_fill=0.5,
+                 char_aspect=None):
+        # Samples only depend on the seed and their index,
+        # without a seed, one is drawn so that they can still be replayed
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        # Only use fonts that have every character of the text,
+        # for the font samplers that have a coverage index
+        self.font_coverage = font_coverage
+        with seeded(seed):
+            self.prepare(texts, backgrounds, fonts, text_colors, count,
+                         color_pairing, palette_file)
+
+        self.background_transform = background_transform
+        self.transform = transform
+        if render_mode not in ("rgba", "mask"):
+            raise ValueError(f"unknown render mode {render_mode}")
+        self.render_mode = render_mode
+        self.text_cache = None
+        if text_cache_bytes > 0:
+            self.text_cache = TextMaskCache(text_cache_bytes)
+        self.chunk_size = chunk_size
+
+        # Optional contrast check of the text color against the actual crop
+        self.crop_contrast = crop_contrast
+        self.crop_tries = crop_tries
+        self.crop_checks = 0
+        self.crop_rejections = 0
+        self.luminance_tables = ByteLRU(256 * 2**20, attrgetter("nbytes"))
+        self.batch_start = 0
+
+        # With bucket widths, every sample is exactly one of the
+        # (bucket_height, width) shapes, see `get_bucketed`
+        if (bucket_height is None) != (bucket_widths is None):
+            raise ValueError("bucket_height and bucket_widths go together")
+        self.bucket_height = bucket_height
+        self.bucket_widths = bucket_widths
+        self.bucket_min_fill = bucket_min_fill
+        if bucket_widths is not None and char_aspect is None:
+            with seeded(seed):
+                char_aspect = self.measure_char_aspect()
+        self.char_aspect = char_aspect
+        self.font_variants = ByteLRU(256, unit_size)
+
+    def prepare(self, texts, backgrounds, fonts, text_colors, count,
+                color_pairing, palette_file):
+        # Called with the random module seeded, some samplers are random
         self.texts = prepare_assets(texts, load_textfile)
         self.count = len(self.texts) if count is None else count
         self.backgrounds = prepare_assets(backgrounds, Image.open)
+        if isinstance(fonts, str) and path.isdir(fonts):
+            fonts = FontPool(fonts, size=48)
         self.fonts = prepare_assets(
             fonts,
             lambda f: ImageFont.truetype(f, size=48)
         )
         self.text_colors = prepare_assets(text_colors, None)
 
-        self.bg_fg_pairings = get_bg_fg_pairings(
-            self.backgrounds, self.text_colors,
-        )
-        self.background_transform = background_transform
-        self.transform = transform
+        # Built here rather than on first use, so that the
+        # pool workers do not each read every font's cmap
+        if self.font_coverage:
+            for sampler in iter_samplers(self.fonts):
+                if hasattr(sampler, "coverage"):
+                    sampler.coverage
 
-        assert len(
-            self.bg_fg_pairings) > 0, "No good color matching found, try changing the background/foreground colors"
-        self.seed = seed
-        if seed is not None:
-            random.seed(seed)
+        # Same for the indexes over the lines of the text samplers
+        # (CoverageSampler, BucketedTexts), or each worker scans the corpus
+        for sampler in iter_samplers(self.texts):
+            for name in ("postings", "index"):
+                if isinstance(getattr(type(sampler), name, None), cached_property):
+                    getattr(sampler, name)
+
+        # Either pair every background with every readable color
+        # up front, or pick a readable color for each sampled background.
+        # The pairings hold every background decoded, which defeats
+        # on-demand samplers like ImageDir, so sampling is the default
+        self.palette_index = PaletteIndex(palette_file)
+        self.bg_fg_pairings = None
+        self.color_sampler = None
+        if color_pairing == "precompute":
+            self.bg_fg_pairings = get_bg_fg_pairings(
+                self.backgrounds, self.text_colors,
+                palette_index=self.palette_index,
+            )
+            assert len(
+                self.bg_fg_pairings) > 0, "No good color matching found, try changing the background/foreground colors"
+        elif color_pairing == "sample":
+            self.color_sampler = ContrastColorSampler(
+                self.text_colors, self.palette_index
+            )
+        else:
+            raise ValueError(f"unknown color pairing {color_pairing}")
+        self.palette_index.save()
 
     def __len__(self):
         return self.count
 
     def __iter__(self):
-        return iter(self[i] for i in range(self.count))
-
-    def __getitem__(self, _):
-        background, text_color = random.choice(self.bg_fg_pairings)
-        text = random.choice(self.texts)
-        font = random.choice(self.fonts)
-        if random.choice([True, False]):
-            text = text.upper()
-        image = generate(background=background,
-                         text=text,
-                         font=font,
-                         text_color=text_color,
-                         transform=self.transform,
-                         background_transform=self.background_transform)
+        for start, stop in self.chunks():
+            for _, image, text in self.generate_range(start, stop):
+                yield image, text
+
+    def chunks(self):
+        return [(start, min(start + self.chunk_size, self.count))
+                for start in range(0, self.count, self.chunk_size)]
+
+    def generate_range(self, start, stop):
+        # Samples are independent, ranges can be generated
+        # in any order, or in different processes
+        for idx in range(start, stop):
+            image, text = self[idx]
+            yield idx, image, text
+
+    def generate_batch(self, n, height, max_width, out=None, start=None, bucket=None):
+        """
+        Generate `n` samples resized to `height` straight into a
+        (n, height, max_width, 3) uint8 array, or into `out` if given.
+        `bucket` is the length bucket of the texts, see `get`.
+
+        Returns the array, the widths of the samples (the rest of each
+        row is zero padding, samples wider than `max_width` are squeezed)
+        and the texts. The samples are the ones at indices `start` to
+        `start + n`, by default the ones following the previous batch.
+        """
+        if out is None:
+            out = np.zeros((n, height, max_width, 3), dtype=np.uint8)
+        if start is None:
+            start = self.batch_start
+        self.batch_start = start + n
+        samples = (self.get(i, bucket) for i in range(start, start + n))
+
+        widths = np.zeros(n, dtype=np.int64)
+        texts = []
+        for i, (image, text) in enumerate(samples):
+            np_image = np.asarray(image)
+            image_height, image_width = np_image.shape[:2]
+            width = round(image_width * height / image_height)
+            width = min(max(width, 1), max_width)
+            if height < image_height:
+                interpolation = cv2.INTER_AREA
+            else:
+                interpolation = cv2.INTER_LINEAR
+            cv2.resize(np_image, (width, height),
+                       dst=out[i, :, :width],
+                       interpolation=interpolation)
+            out[i, :, width:] = 0
+            widths[i] = width
+            texts.append(text)
+        return out, widths, texts
+
+    def pop_stats(self):
+        """
+        What was counted and computed since the last call, for the pool
+        workers to send back to the parent generator (see `add_stats`).
+        """
+        stats = dict(crop_checks=self.crop_checks,
+                     crop_rejections=self.crop_rejections,
+                     palettes=self.palette_index.pop_new(),
+                     mix_counts=[list(s.counts) for s in self.mix_samplers])
+        self.crop_checks = 0
+        self.crop_rejections = 0
+        for sampler in self.mix_samplers:
+            sampler.counts[:] = [0] * len(sampler.counts)
+        return stats
+
+    def add_stats(self, stats):
+        self.crop_checks += stats["crop_checks"]
+        self.crop_rejections += stats["crop_rejections"]
+        self.palette_index.update(stats["palettes"])
+        for sampler, counts in zip(self.mix_samplers, stats["mix_counts"]):
+            sampler.counts[:] = [a + b for a, b in zip(sampler.counts, counts)]
+
+    @cached_property
+    def mix_samplers(self):
+        # Samplers counting their draws per source (MixSampler)
+        return [sampler
+                for samplers in (self.texts, self.backgrounds,
+                                 self.fonts, self.text_colors)
+                for sampler in iter_samplers(samplers)
+                if hasattr(sampler, "shares")]
+
+    @property
+    def rejection_rate(self):
+        if self.crop_checks == 0:
+            return 0
+        return self.crop_rejections / self.crop_checks
+
+    def get_luminance_table(self, background):
+        # The background samplers' own tables first (ImageDir),
+        # they can be preprocessed and cached on disk
+        table = find_table(self.backgrounds, background)
+        if table is not None:
+            return table
+        key = image_key(background)
+        if key is None:
+            return LuminanceTable.from_image(background)
+        return self.luminance_tables.get(
+            key, partial(LuminanceTable.from_image, background))
+
+    def check_crop(self, text_color, background, crop_box):
+        table = self.get_luminance_table(background)
+        contrast = get_contrast(table.mean(crop_box), get_luminance(text_color))
+        self.crop_checks += 1
+        if contrast < self.crop_contrast:
+            self.crop_rejections += 1
+            return False
+        return True
+
+    def get_rng(self, idx):
+        return SampleRandom(self.seed, idx)
+
+    def sample_background(self, rng=random, max_tries=100):
+        if self.bg_fg_pairings is not None:
+            return rng.choice(self.bg_fg_pairings)
+
+        for _ in range(max_tries):
+            background = draw(self.backgrounds, rng)
+            text_color = self.color_sampler.sample(background, rng)
+            if text_color is not None:
+                return background, text_color
+        raise RuntimeError(
+            "No good color matching found, try changing the background/foreground colors")
+
+    def sample_text(self, rng=random, max_tries=10, **options):
+        """
+        Draw a text and a font that can render it. The options go to
+        the text samplers, like `bucket` for BucketedTexts.
+
+        The text is drawn again when none is found or no font can
+        render it, after `max_tries` any text is kept with any font.
+        """
+        for _ in range(max_tries):
+            text = draw(self.texts, rng, **options)
+            if text is None:
+                continue
+            if rng.choice([True, False]):
+                text = text.upper()
+            if not self.font_coverage:
+                return text, draw(self.fonts, rng)
+            font = draw(self.fonts, rng, text=text)
+            if font is not None:
+                return text, font
+        if text is None:
+            text = draw(self.texts, rng)
+        return text, draw(self.fonts, rng)
+
+    def measure_char_aspect(self, num_fonts=8):
+        # Median width / height ratio of a character, over a few fonts
+        text = "The quick brown fox jumps over the lazy dog 0123456789"
+        aspects = []
+        for _ in range(num_fonts):
+            width, height = mask_size(text, draw(self.fonts))
+            aspects.append(width / max(height, 1) / len(text))
+        return float(np.median(aspects))
+
+    @cached_property
+    def length_buckets(self):
+        # The first BucketedTexts sampler, its buckets are used for all
+        for sampler in iter_samplers(self.texts):
+            if hasattr(sampler, "get_bucket"):
+                return sampler
+        return None
+
+    def get_length_bucket(self, aspect):
+        # Bucket of the text length filling the middle of the fill range
+        if self.length_buckets is None:
+            return None
+        fill = (1 + self.bucket_min_fill) / 2
+        length = aspect * fill / self.char_aspect
+        return max(self.length_buckets.get_bucket(length), 0)
+
+    def sample_fitting_text(self, aspect, rng=random, max_tries=5, **options):
+        """
+        Draw a text and a font whose rendered width / height ratio is
+        at most `aspect`, and preferably more than `bucket_min_fill`
+        of it. The texts come from the length bucket of BucketedTexts
+        that should fit, unless `bucket` is given. After `max_tries`,
+        the widest text that fits is kept, or as a last resort, the
+        last one is cut to fit, at a space if there is one.
+        """
+        if "bucket" not in options:
+            bucket = self.get_length_bucket(aspect)
+            if bucket is not None:
+                options = dict(options, bucket=bucket)
+        best, best_aspect = None, 0
+        for _ in range(max_tries):
+            text, font = self.sample_text(rng, **options)
+            width, height = mask_size(text, font)
+            text_aspect = width / max(height, 1)
+            if text_aspect <= aspect and text_aspect > best_aspect:
+                best, best_aspect = (text, font), text_aspect
+            if aspect * self.bucket_min_fill < text_aspect <= aspect:
+                break
+        if best is not None:
+            return best
+        length = max(int(len(text) * aspect / text_aspect), 1)
+        cut = text[:length]
+        if " " in cut.strip() and not text[length:length + 1].isspace():
+            cut = cut.rstrip().rsplit(" ", 1)[0]
+        return cut.strip() or text[:length], font
+
+    def get_font_variant(self, font, size):
+        if getattr(font, "size", size) == size or not hasattr(font, "font_variant"):
+            return font
+        key = (font_id(font)[:2], size)
+        return self.font_variants.get(key, lambda: font.font_variant(size=size))
+
+    def get_bucketed(self, rng, **options):
+        # The text is padded to the aspect ratio of the bucket,
+        # so that the one resize to the bucket shape does not distort it
+        height = self.bucket_height
+        width = rng.choice(self.bucket_widths)
+        aspect = width / height
+        background, text_color = self.sample_background(rng)
+        text, font = self.sample_fitting_text(aspect, rng, **options)
+
+        # Rendered at about twice the final height,
+        # downscaling once keeps the edges smooth
+        _, text_height = mask_size(text, font)
+        size = max(round(font.size * 2 * height / max(text_height, 1)), 1)
+        font = self.get_font_variant(font, size)
+
+        pad = PadToAspect(aspect)
+        if self.transform is None:
+            transform = pad
+        else:
+            transform = RandomApply([self.transform, pad], [1, 1])
+        image = None
+        for _ in range(self.crop_tries):
+            image = self.render(background, text_color, text, font, rng,
+                                transform=transform)
+            if image is not None:
+                break
+            background, text_color = self.sample_background(rng)
+        if image is None:
+            image = self.render(background, text_color, text, font, rng,
+                                check=False, transform=transform)
+
+        np_image = cv2.resize(np.asarray(image), (width, height),
+                              interpolation=cv2.INTER_AREA)
+        return Image.fromarray(np_image), text
+
+    def render(self, background, text_color, text, font, rng=random,
+               check=True, transform=None):
+        # `transform` replaces the generator's own transform if given
+        crop_check = None
+        if check and self.crop_contrast is not None:
+            crop_check = partial(self.check_crop, text_color)
+        return generate(background=background,
+                        text=text,
+                        font=font,
+                        text_color=text_color,
+                        transform=transform or self.transform,
+                        background_transform=self.background_transform,
+                        cache=self.text_cache,
+                        render_mode=self.render_mode,
+                        crop_check=crop_check,
+                        crop_tries=self.crop_tries,
+                        rng=rng)
+
+    @cached_property
+    def text_observers(self):
+        # Text samplers keeping count of the rendered texts (CoverageSampler)
+        return [sampler for sampler in iter_samplers(self.texts)
+                if hasattr(sampler, "emitted")]
+
+    def __getitem__(self, idx):
+        return self.get(idx)
+
+    def get(self, idx, bucket=None):
+        """
+        The sample at `idx`, the same as `self[idx]`. With `bucket`,
+        its text is drawn from that length bucket of the BucketedTexts
+        samplers, the other text samplers ignore it.
+        """
+        # Every draw comes from the sample's own generator, the same
+        # index always gives the same sample, unless a text sampler
+        # depends on the texts emitted before (CoverageSampler)
+        rng = self.get_rng(idx)
+        options = {} if bucket is None else dict(bucket=bucket)
+        if self.bucket_widths is not None:
+            image, text = self.get_bucketed(rng, **options)
+        else:
+            image, text = self.get_sample(rng, **options)
+        for sampler in self.text_observers:
+            sampler.emitted(text)
+        return image, text
+
+    def get_sample(self, rng, **options):
+        background, text_color = self.sample_background(rng)
+        text, font = self.sample_text(rng, **options)
+
+        # Resample the background and color of rejected crops,
+        # the last try is kept unchecked if all of them fail
+        for _ in range(self.crop_tries):
+            image = self.render(background, text_color, text, font, rng)
+            if image is not None:
+                return image, text
+            background, text_color = self.sample_background(rng)
+        image = self.render(background, text_color, text, font, rng, check=False)
         return image, text
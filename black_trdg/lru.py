@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def unit_size(value):
+    # Every value counts as one, to bound the number of values
+    return 1
+
+
+class ByteLRU:
+    """
+    Least recently used cache, bounded by the total
+    size of its values, as measured by `sizeof(value)`.
+    """
+
+    def __init__(self, max_bytes, sizeof=image_nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def get(self, key, create):
+        value = self.items.get(key, None)
+        if value is not None:
+            self.hits += 1
+            self.items.move_to_end(key)
+            return value
+
+        self.misses += 1
+        value = create()
+        nbytes = self.sizeof(value)
+        if nbytes <= self.max_bytes:
+            self.items[key] = value
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.nbytes -= self.sizeof(evicted)
+        return value
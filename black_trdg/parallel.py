@@ -0,0 +1,47 @@
+from multiprocessing import Pool
+
+# Per-process state, set by the pool initializer
+_worker = {}
+
+
+def _initialize(generator, consume):
+    _worker["generator"] = generator
+    _worker["consume"] = consume
+
+
+def _run(chunk):
+    # The counts and palettes of the chunk go back with its results
+    generator = _worker["generator"]
+    consume = _worker["consume"]
+    results = list(_consume_range(generator, consume, *chunk))
+    return results, generator.pop_stats()
+
+
+def _consume_range(generator, consume, start, stop):
+    for idx, image, text in generator.generate_range(start, stop):
+        yield idx, consume(idx, image, text)
+
+
+def generate(generator, consume, workers=1, start=0):
+    """
+    Generate the samples of `generator` from index `start` and
+    yield `(index, consume(index, image, text))` in index order.
+
+    `consume` runs inside the worker processes, so the expensive
+    parts (encoding, saving) are parallelized as well. Each worker
+    takes whole index ranges from `generator.chunks()`, samples only
+    depend on their index, so the output does not depend on `workers`.
+    The workers' counts and palettes are added to `generator`'s.
+    """
+    chunks = [(max(a, start), b) for (a, b) in generator.chunks() if b > start]
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _consume_range(generator, consume, *chunk)
+        return
+
+    with Pool(workers,
+              initializer=_initialize,
+              initargs=(generator, consume)) as pool:
+        for results, stats in pool.imap(_run, chunks):
+            generator.add_stats(stats)
+            yield from results
@@ -1,6 +1,8 @@
-from .texts import VocabRep, VocabRand, TextFile, LongTextFile
-from .bg import Color, ImageDir
-from .other import FontDir, FontFile
+from .texts import VocabRep, VocabRand, VocabBlock, TextFile, LongTextFile, MmapTextFile, MmapTextDir, CoverageSampler, BucketedTexts
+from .bg import Color, ImageDir, BackgroundDirectory
+from .other import FontPool, FontDir, FontDirectory, FontFile
+from .base import draw
+import numpy as np
 
 
 class CombineSampler:
@@ -30,3 +32,85 @@ class CombineSampler:
         #     print(s, len(s), s[sample_idx])
         #     print("+"*300)
         #     return
+
+    def sample(self, rng, **options):
+        # Same distribution as rng.choice(self)
+        idx = rng.randrange(len(self))
+        sampler_idx = idx % self.n_samplers
+        sampler = self.samplers[sampler_idx]
+        if hasattr(sampler, "sample"):
+            return draw(sampler, rng, **options)
+        return sampler[(idx // self.n_samplers) % self.lens[sampler_idx]]
+
+
+def build_alias_table(probabilities):
+    # Walker's alias method: column i is kept with probability
+    # prob[i], otherwise it is replaced by alias[i]
+    n = len(probabilities)
+    prob = [p * n for p in probabilities]
+    alias = list(range(n))
+    small = [i for i in range(n) if prob[i] < 1]
+    large = [i for i in range(n) if prob[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1
+        (small if prob[l] < 1 else large).append(l)
+    for i in small + large:
+        prob[i] = 1
+    return prob, alias
+
+
+class MixSampler:
+    """
+    Draw from `samplers` with probabilities proportional to `weights`,
+    times `len(sampler) ** (1 / temperature)` if `temperature` is set:
+    at 1 the mix follows the sizes, higher values flatten it.
+
+    `sample(rng)` is O(1) with Walker's alias method and counts the
+    draws of each sampler in `counts`. Indexing and iterating go
+    through the samplers one after the other, unweighted.
+    """
+
+    def __init__(self, samplers, weights=None, temperature=None):
+        self.samplers = samplers
+        self.lens = list(map(len, self.samplers))
+        for i, l in enumerate(self.lens):
+            if l < 1:
+                raise RuntimeError(f"sampler {samplers[i]} has length {l}")
+        if weights is None:
+            weights = [1] * len(samplers)
+        assert len(weights) == len(samplers)
+
+        weights = np.array(weights, dtype=np.float64)
+        if temperature is not None:
+            weights = weights * np.array(self.lens, dtype=np.float64) ** (1 / temperature)
+        self.probabilities = weights / weights.sum()
+        self.prob, self.alias = build_alias_table(self.probabilities.tolist())
+        self.ends = np.cumsum(self.lens)
+        self.counts = [0] * len(samplers)
+
+    @property
+    def shares(self):
+        # Fraction of the draws that went to each sampler
+        total = max(sum(self.counts), 1)
+        return [count / total for count in self.counts]
+
+    def __iter__(self):
+        for sampler in self.samplers:
+            yield from sampler
+
+    def __len__(self):
+        return int(self.ends[-1])
+
+    def __getitem__(self, idx):
+        i = int(np.searchsorted(self.ends, idx, side="right"))
+        start = int(self.ends[i - 1]) if i > 0 else 0
+        return self.samplers[i][idx - start]
+
+    def sample(self, rng, **options):
+        i = rng.randrange(len(self.samplers))
+        if rng.random() >= self.prob[i]:
+            i = self.alias[i]
+        self.counts[i] += 1
+        return draw(self.samplers[i], rng, **options)
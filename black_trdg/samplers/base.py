@@ -1,5 +1,9 @@
 from abc import ABC, abstractclassmethod
 from dataclasses import dataclass
+from functools import lru_cache
+from inspect import signature, Parameter
+import numpy as np
+import random
 
 
 class Sampler(ABC):
@@ -9,6 +13,9 @@ class Sampler(ABC):
     Any sampler needs to work with:
     - random.choice
     - for loops, enumerate...
+
+    Samplers that are random themselves also have a `sample(rng)`
+    method, which draws from `rng` instead of the `random` module.
     """
     @abstractclassmethod
     def __len__(self):
@@ -28,3 +35,63 @@ class RandomSampler(Sampler):
 
     def __len__(self):
         return self.count
+
+
+@lru_cache(maxsize=None)
+def sample_options(cls):
+    # Option names of `cls.sample`, None if it takes any option
+    parameters = list(signature(cls.sample).parameters.values())[2:]
+    if any(p.kind == Parameter.VAR_KEYWORD for p in parameters):
+        return None
+    return frozenset(p.name for p in parameters)
+
+
+def draw(sampler, rng=random, **options):
+    # One random sample, from `rng` only, the options
+    # are for the samplers that know what to do with them,
+    # the others do not get them
+    if hasattr(sampler, "sample"):
+        if options:
+            names = sample_options(type(sampler))
+            if names is not None:
+                options = {k: v for k, v in options.items() if k in names}
+        return sampler.sample(rng, **options)
+    return rng.choice(sampler)
+
+
+def numpy_rng(rng):
+    # NumPy generator of `rng`: the sample's own one (SampleRandom.np),
+    # or one seeded from `rng`, for the random module
+    if isinstance(rng, np.random.Generator):
+        return rng
+    np_rng = getattr(rng, "np", None)
+    if np_rng is None:
+        np_rng = np.random.default_rng(rng.getrandbits(64))
+    return np_rng
+
+
+def draw_count(rng, key):
+    # Number of earlier draws for `key` from this rng,
+    # kept on the rng, so it is per sample with SampleRandom
+    counts = rng.__dict__.setdefault("draw_counts", {})
+    count = counts.get(key, 0)
+    counts[key] = count + 1
+    return count
+
+
+def iter_samplers(sampler):
+    # The sampler and the ones it combines, recursively
+    yield sampler
+    for child in getattr(sampler, "samplers", ()):
+        yield from iter_samplers(child)
+
+
+def find_table(sampler, image):
+    # Luminance tables of `image` from the sampler it was drawn
+    # from, looking into combined samplers, None if none has them
+    for child in iter_samplers(sampler):
+        if hasattr(child, "get_image_table"):
+            table = child.get_image_table(image)
+            if table is not None:
+                return table
+    return None
@@ -1,31 +1,96 @@
 from dataclasses import dataclass
 from typing import Optional, Tuple
 from PIL import Image
-from os import path, listdir
-from functools import cached_property, lru_cache
+from os import path, listdir, makedirs, replace
+from functools import cached_property, partial
+from operator import attrgetter
+from hashlib import md5
 from tqdm import tqdm
 import random
 
+from ..lru import ByteLRU
+from ..colors import LuminanceTable
+
+
+def get_cache_file(cache_dir, file, *options):
+    # Cache files are invalidated when the source file is modified
+    key = ":".join(map(str, (path.abspath(file), path.getmtime(file)) + options))
+    return path.join(cache_dir, md5(key.encode()).hexdigest())
+
+
+def load_image(file, max_size=None, cache_dir=None):
+    """
+    Decode an image, downscaled to fit `max_size` if given.
+    The downscaled images are cached in `cache_dir` if given.
+    """
+    if max_size is None:
+        image = Image.open(file)
+        image.load()
+        return image
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = get_cache_file(cache_dir, file, tuple(max_size))
+        for ext in (".jpg", ".png"):
+            if path.isfile(cache_file + ext):
+                # Named after the source file, like the decoded ones
+                image = load_image(cache_file + ext)
+                image.filename = file
+                return image
+
+    image = Image.open(file)
+    image.thumbnail(max_size)
+
+    if cache_file is not None:
+        # JPEG is compact and fast to decode, PNG for the other modes
+        ext = ".jpg" if image.mode in ("RGB", "L") else ".png"
+        tmp_file = path.join(cache_dir, "." + path.basename(cache_file) + ext)
+        makedirs(cache_dir, exist_ok=True)
+        image.save(tmp_file, quality=95)
+        replace(tmp_file, cache_file + ext)
+    return image
+
 
 @dataclass(eq=True, frozen=True)
 class ImageDir:
+    """
+    Images in a directory, decoded on demand.
+
+    Decoded images are kept in an LRU cache of at most `max_bytes`,
+    if `max_size` is set, images are downscaled to fit it and the
+    downscaled versions can be cached on disk in `cache_dir`.
+
+    `get_table(i)` gives the luminance summed-area tables of an image,
+    for O(1) crop statistics, they are kept in an LRU cache of at most
+    `max_table_bytes` and in `cache_dir` too. Use `preprocess` to build
+    all of them up front. `get_image_table(image)` finds the tables of
+    an image returned by this sampler, see Generator's crop check.
+    """
     path: str
     max_size: Optional[Tuple[int, int]] = None
+    max_bytes: int = 1024 * 2**20
+    cache_dir: Optional[str] = None
+    max_table_bytes: int = 256 * 2**20
 
     @cached_property
     def files(self):
+        # Opening only parses the header, pixels are not decoded
         files = []
         pbar = tqdm(listdir(self.path), desc="Verifying files")
         for file in pbar:
             try:
                 file_path = path.join(self.path, file)
-                Image.open(file_path)
-                files.append(file_path)
+                with Image.open(file_path):
+                    files.append(file_path)
             except Exception:
                 print(f"Can't load {file}")
 
         return files
 
+    @cached_property
+    def cache(self):
+        return ByteLRU(self.max_bytes)
+
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
@@ -33,13 +98,55 @@ class ImageDir:
     def __len__(self):
         return len(self.files)
 
-    @lru_cache
     def __getitem__(self, i):
-        image = Image.open(self.files[i])
-        image.load()
-        if self.max_size is not None:
-            image.thumbnail(self.max_size)
-        return image
+        load = partial(load_image, self.files[i], self.max_size, self.cache_dir)
+        return self.cache.get(i, load)
+
+    @cached_property
+    def table_cache(self):
+        return ByteLRU(self.max_table_bytes, attrgetter("nbytes"))
+
+    def load_table(self, i):
+        cache_file = None
+        if self.cache_dir is not None:
+            max_size = self.max_size and tuple(self.max_size)
+            cache_file = get_cache_file(
+                self.cache_dir, self.files[i], max_size, "luminance8"
+            ) + ".npz"
+            if path.isfile(cache_file):
+                return LuminanceTable.load(cache_file)
+
+        table = LuminanceTable.from_image(self[i])
+        if cache_file is not None:
+            tmp_file = path.join(self.cache_dir, "." + path.basename(cache_file))
+            makedirs(self.cache_dir, exist_ok=True)
+            table.save(tmp_file)
+            replace(tmp_file, cache_file)
+        return table
+
+    def get_table(self, i):
+        return self.table_cache.get(i, partial(self.load_table, i))
+
+    @cached_property
+    def file_indices(self):
+        return {file: i for i, file in enumerate(self.files)}
+
+    def get_image_table(self, image):
+        # None for images that do not come from this directory
+        i = self.file_indices.get(getattr(image, "filename", None), None)
+        return None if i is None else self.get_table(i)
+
+    def crop_stats(self, i, box):
+        # Mean and variance of the luminance of the i-th image inside box
+        return self.get_table(i).stats(box)
+
+    def preprocess(self):
+        for i in tqdm(range(len(self)), desc="Building luminance tables"):
+            self.get_table(i)
+
+
+# The name of the same sampler in the old samplers module
+BackgroundDirectory = ImageDir
 
 
 @dataclass(eq=True, frozen=True)
@@ -57,11 +164,14 @@ class Color:
         return self.count
 
     def __getitem__(self, idx):
+        return self.sample(random)
+
+    def sample(self, rng):
         min_r, min_g, min_b = self.a
         max_r, max_g, max_b = self.b
-        r = random.randint(min_r, max_r)
-        g = random.randint(min_g, max_g)
-        b = random.randint(min_b, max_b)
+        r = rng.randint(min_r, max_r)
+        g = rng.randint(min_g, max_g)
+        b = rng.randint(min_b, max_b)
         c = (r, g, b)
         if self.image:
             return Image.new("RGB", (32, 32), c)
@@ -1,32 +1,120 @@
 from PIL import ImageFont
+from dataclasses import dataclass
+from typing import Tuple, Union, Optional
+from functools import cached_property, partial
 from os import listdir
+from os import path as ospath
 from os.path import join as joinpath
+import random
 
+from ..lru import ByteLRU
+from ..coverage import CoverageIndex, mask_indices
 
-class FontDir:
-    def __init__(self, path, size=36):
-        self.fonts = []
-        for file in listdir(path):
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc", ".otc", ".woff", ".woff2")
+
+
+def font_nbytes(font):
+    # Approximated by the size of the font file
+    return ospath.getsize(font.path)
+
+
+@dataclass(eq=True, frozen=True)
+class FontPool:
+    """
+    Fonts in a directory, loaded on first use.
+
+    Only the file names are listed up front. Loaded fonts are kept
+    in an LRU cache keyed by (file, size), of at most `max_bytes` of
+    font files. `size` is either a font size or a (min, max) range,
+    a size is drawn from it every time a font is sampled.
+
+    `sample(rng, text)` only picks fonts having every character of
+    `text`, from a CoverageIndex of the fonts kept in `coverage_file`.
+    """
+    path: str
+    size: Union[int, Tuple[int, int]] = 36
+    max_bytes: int = 256 * 2**20
+    coverage_file: Optional[str] = None
+
+    @cached_property
+    def files(self):
+        return [joinpath(self.path, file)
+                for file in sorted(listdir(self.path))
+                if file.lower().endswith(FONT_EXTENSIONS)]
+
+    @cached_property
+    def cache(self):
+        return ByteLRU(self.max_bytes, font_nbytes)
+
+    @cached_property
+    def broken(self):
+        return set()
+
+    @cached_property
+    def coverage(self):
+        return CoverageIndex(self.files, self.coverage_file)
+
+    @property
+    def sizes(self):
+        if isinstance(self.size, int):
+            return self.size, self.size
+        return tuple(self.size)
+
+    def sample_size(self, rng=random):
+        return rng.randint(*self.sizes)
+
+    def load(self, i, size):
+        return ImageFont.truetype(self.files[i], size=size)
+
+    def get(self, i, size):
+        # Fonts that can't be loaded are skipped for the next one
+        for j in range(len(self)):
+            k = (i + j) % len(self)
+            if k in self.broken:
+                continue
             try:
-                fpath = joinpath(path, file)
-                font = ImageFont.truetype(fpath, size=36)
-                self.fonts.append(font)
+                return self.cache.get((k, size), partial(self.load, k, size))
             except Exception:
-                print(f"Can't load {file}")
+                print(f"Can't load {self.files[k]}")
+                self.broken.add(k)
+        raise RuntimeError(f"No font can be loaded from {self.path}")
 
     def __iter__(self):
-        return iter(self.fonts)
+        for i in range(len(self)):
+            yield self[i]
 
     def __len__(self):
-        return len(self.fonts)
+        return len(self.files)
 
     def __getitem__(self, i):
-        return self.fonts[i]
+        return self.get(i, self.sample_size(random))
+
+    def sample(self, rng, text=None):
+        if text is None:
+            return self.get(rng.randrange(len(self)), self.sample_size(rng))
+
+        # None if no font can render the text
+        size = self.sample_size(rng)
+        mask = self.coverage.covering(text)
+        for i in self.broken:
+            mask &= ~(1 << i)
+        while mask != 0:
+            i = int(rng.choice(mask_indices(mask)))
+            font = self.get(i, size)
+            if i not in self.broken:
+                return font
+            mask &= ~(1 << i)
+        return None
+
+
+# Fonts used to be all loaded up front, same options
+FontDir = FontPool
+FontDirectory = FontPool
 
 
 class FontFile:
     def __init__(self, path, size=36):
-        self.font = ImageFont.truetype(path, size=36)
+        self.font = ImageFont.truetype(path, size=size)
 
     def __iter__(self):
         return iter([self.font])
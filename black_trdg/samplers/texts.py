@@ -1,10 +1,21 @@
 from abc import ABC, abstractclassmethod
-from dataclasses import dataclass
-from typing import Tuple, Optional
+from dataclasses import dataclass, field
+from typing import Tuple, Optional, Dict, Any
+from collections import Counter
+from hashlib import blake2b
 from functools import lru_cache, cached_property
+from os import path, getpid
+from io import BytesIO
+from tqdm import tqdm
+import numpy as np
 import random
 import toolz
 
+from ..utils import find
+from ..lru import ByteLRU, unit_size
+from .base import draw_count
+from ..writers import write_atomic
+
 
 @dataclass(frozen=True, eq=True)
 class VocabSampler(ABC):
@@ -18,8 +29,9 @@ class VocabSampler(ABC):
         if self.vocab is not None:
             return self.vocab
         elif self.vocab_file is not None:
+            # Sorted, the order of a set changes between runs
             with open(self.vocab_file, encoding=self.encoding) as f:
-                return ''.join(set(f.read()))
+                return ''.join(sorted(set(f.read())))
         else:
             raise RuntimeError("Either vocab or vocab_file must present")
 
@@ -73,11 +85,138 @@ class VocabRand(VocabSampler):
 
     def __iter__(self):
         for i in range(len(self)):
-            yield self[0]
+            yield self[i]
 
     def __getitem__(self, i):
-        k = random.randint(self.min_length, self.max_length)
-        text = ''.join(random.choices(self._vocab, k=k))
+        return self.sample(random)
+
+    def sample(self, rng):
+        k = rng.randint(self.min_length, self.max_length)
+        text = ''.join(rng.choices(self._vocab, k=k))
+        return text
+
+
+def count_chars(file, encoding='utf-8', chunk_size=2**24):
+    counts = Counter()
+    with open(file, encoding=encoding) as f:
+        while chunk := f.read(chunk_size):
+            counts.update(chunk)
+    return counts
+
+
+@dataclass(frozen=True, eq=True)
+class VocabBlock(VocabRand):
+    """
+    VocabRand generating `block_size` strings at a time with NumPy:
+    lengths and character indices are drawn in bulk, decoded at once
+    through a codepoint array, and handed out in order by `self[i]`.
+
+    Characters follow `weights` ({char: weight}) or their counts in
+    `corpus_file` if given, uniform otherwise. Each process draws from
+    its own stream, seeded by the first index it is asked for, so the
+    strings do not depend on the index itself.
+
+    `sample(rng)`, which the Generator uses, takes the strings from
+    blocks keyed by (seed, index // block_size), read from the rng of
+    the sample (SampleRandom), so that they only depend on the seed
+    and the index. The sample at `index` gets string `index %
+    block_size` of its block, further draws for the same sample take
+    random strings of the block. Other rngs get one string at a time.
+    """
+    weights: Optional[Dict[str, float]] = field(default=None, hash=False)
+    corpus_file: Optional[str] = None
+    block_size: int = 4096
+
+    @cached_property
+    def codepoints(self):
+        return np.array([ord(c) for c in self._vocab], dtype=np.uint32)
+
+    @cached_property
+    def probabilities(self):
+        if self.weights is not None:
+            weights = [self.weights.get(c, 0) for c in self._vocab]
+        elif self.corpus_file is not None:
+            # Smoothed, so that every character can be drawn
+            counts = count_chars(self.corpus_file, self.encoding)
+            weights = [counts[c] + 1 for c in self._vocab]
+        else:
+            return None
+        weights = np.array(weights, dtype=np.float64)
+        return weights / weights.sum()
+
+    @cached_property
+    def cdf(self):
+        # Characters are drawn by searching uniform numbers in there
+        if self.probabilities is None:
+            return None
+        cdf = np.cumsum(self.probabilities)
+        return cdf / cdf[-1]
+
+    def draw_indices(self, rng, n):
+        if self.cdf is None:
+            return rng.integers(0, self.vocab_size, n)
+        indices = np.searchsorted(self.cdf, rng.random(n), side="right")
+        return np.minimum(indices, self.vocab_size - 1)
+
+    @cached_property
+    def stream(self):
+        return dict(pid=None, rng=None, texts=[], position=0)
+
+    @cached_property
+    def blocks(self):
+        # A few blocks, samples are mostly generated in index order
+        return ByteLRU(4, unit_size)
+
+    @cached_property
+    def block_key(self):
+        # Tells the blocks of different samplers apart, on every run
+        config = repr((self._vocab, self.min_length, self.max_length,
+                       self.block_size, self.cum_weights))
+        digest = blake2b(config.encode("utf-8"), digest_size=4).digest()
+        return int.from_bytes(digest, "little")
+
+    def make_block(self, seed, block):
+        sequence = np.random.SeedSequence(seed, spawn_key=(block, self.block_key))
+        return self.generate_block(np.random.Generator(np.random.Philox(sequence)))
+
+    def get_block(self, seed, block):
+        key = (seed, block)
+        return self.blocks.get(key, lambda: self.make_block(seed, block))
+
+    def generate_block(self, rng):
+        lengths = rng.integers(self.min_length, self.max_length + 1, self.block_size)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        indices = self.draw_indices(rng, ends[-1])
+        text = self.codepoints[indices].tobytes().decode("utf-32-le")
+        return [text[a:b] for a, b in zip(starts.tolist(), ends.tolist())]
+
+    @cached_property
+    def cum_weights(self):
+        return None if self.cdf is None else self.cdf.tolist()
+
+    def sample(self, rng):
+        sequence = getattr(rng, "seed_sequence", None)
+        if sequence is None:
+            k = rng.randint(self.min_length, self.max_length)
+            return ''.join(rng.choices(self._vocab, cum_weights=self.cum_weights, k=k))
+
+        index = sequence.spawn_key[0]
+        texts = self.get_block(sequence.entropy, index // self.block_size)
+        if draw_count(rng, self.block_key) == 0:
+            return texts[index % self.block_size]
+        return texts[rng.randrange(self.block_size)]
+
+    def __getitem__(self, i):
+        stream = self.stream
+        if stream["pid"] != getpid():
+            stream.update(pid=getpid(), rng=np.random.default_rng(i),
+                          texts=[], position=0)
+        if stream["position"] >= len(stream["texts"]):
+            stream["texts"] = self.generate_block(stream["rng"])
+            stream["position"] = 0
+        text = stream["texts"][stream["position"]]
+        stream["position"] += 1
         return text
 
 
@@ -101,49 +240,470 @@ class TextFile:
         return self.lines[i]
 
 
+def get_line_offsets(data, chunk_size=64 * 2**20):
+    # Start of every line, then the end of the data
+    ends = [np.zeros(1, dtype=np.uint64)]
+    chunks = range(0, len(data), chunk_size)
+    for start in tqdm(chunks, desc="Indexing lines", disable=len(chunks) < 16):
+        chunk = data[start:start + chunk_size]
+        ends.append(np.flatnonzero(chunk == ord("\n")).astype(np.uint64) + (start + 1))
+    offsets = np.concatenate(ends)
+    if offsets[-1] != len(data):
+        offsets = np.append(offsets, np.uint64(len(data)))
+    return offsets
+
+
+@dataclass(frozen=True, eq=True)
+class MmapTextFile:
+    """
+    Lines of a text file, read from a memory map.
+
+    The line offsets are a uint64 array, cached in `<file>.lines.npy`
+    until the file is modified, so that a line is read without keeping
+    any per-line Python object. The encoding must be ASCII compatible.
+    """
+    file: str
+    encoding: str = 'utf-8'
+
+    @cached_property
+    def data(self):
+        if path.getsize(self.file) == 0:
+            return np.zeros(0, dtype=np.uint8)
+        return np.memmap(self.file, dtype=np.uint8, mode="r")
+
+    @cached_property
+    def offsets(self):
+        index_file = self.file + ".lines.npy"
+        if path.isfile(index_file) and path.getmtime(index_file) >= path.getmtime(self.file):
+            return np.load(index_file, mmap_mode="r")
+
+        offsets = get_line_offsets(self.data)
+        io = BytesIO()
+        np.save(io, offsets)
+        try:
+            write_atomic(index_file, io.getvalue())
+        except OSError:
+            print(f"Can't save {index_file}")
+        return offsets
+
+    def __getstate__(self):
+        # The maps are opened again after pickling, instead of copied
+        state = dict(self.__dict__)
+        state.pop("data", None)
+        state.pop("offsets", None)
+        return state
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        line = self.data[start:end].tobytes()
+        return line.decode(self.encoding, errors="replace").strip()
+
+
+@dataclass(frozen=True, eq=True)
+class MmapTextDir:
+    """
+    Lines of all the files matching `suffix` in a directory,
+    as one sampler, see MmapTextFile.
+    """
+    path: str
+    suffix: str = "*.txt"
+    encoding: str = 'utf-8'
+
+    @cached_property
+    def files(self):
+        files = sorted(find(self.path, name=self.suffix, type="f"))
+        return [MmapTextFile(file, self.encoding) for file in files]
+
+    @cached_property
+    def ends(self):
+        # Number of lines up to the end of each file
+        return np.cumsum([len(file) for file in self.files], dtype=np.int64)
+
+    def __iter__(self):
+        for file in self.files:
+            yield from file
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.files) > 0 else 0
+
+    def __getitem__(self, i):
+        f = int(np.searchsorted(self.ends, i, side="right"))
+        start = int(self.ends[f - 1]) if f > 0 else 0
+        return self.files[f][i - start]
+
+
+def get_sources(texts):
+    # The files behind a text sampler, as path:mtime:size,
+    # to tell when an index built over them is stale
+    if hasattr(texts, "file"):
+        files = [texts.file]
+    else:
+        files = [getattr(f, "file", None) for f in getattr(texts, "files", [])]
+    return [f"{path.abspath(f)}:{path.getmtime(f)}:{path.getsize(f)}"
+            for f in files if f is not None]
+
+
+@dataclass
+class CoverageSampler:
+    """
+    Lines of `texts`, a sampler or a file read with MmapTextFile,
+    picked to balance the characters of a vocab.
+
+    On first use, an inverted index of up to `max_lines_per_char`
+    line ids per character is built over the lines, it is kept in
+    `index_file` if given, like BucketedTexts'. With probability
+    `balance`, a sample is a line having the character emitted the
+    least so far, otherwise any line. `counts` is the number of times
+    each character of `chars` was emitted, in this process.
+
+    The Generator reports the texts it actually renders, after case
+    changes and font fallbacks, with `emitted(text)`. Used alone, the
+    sampler counts the texts it returns itself.
+
+    Unlike the other samplers, it depends on what was emitted before,
+    so samples are not a pure function of (seed, index): they change
+    with the number of workers and the order of generation.
+    """
+    texts: Any
+    vocab: Optional[str] = None
+    vocab_file: Optional[str] = None
+    balance: float = 0.5
+    max_lines_per_char: int = 10000
+    encoding: str = 'utf-8'
+    index_file: Optional[str] = None
+
+    def __post_init__(self):
+        if isinstance(self.texts, str):
+            self.texts = MmapTextFile(self.texts, self.encoding)
+
+    @cached_property
+    def chars(self):
+        if self.vocab is not None:
+            vocab = self.vocab
+        elif self.vocab_file is not None:
+            with open(self.vocab_file, encoding=self.encoding) as f:
+                vocab = f.read()
+        else:
+            raise RuntimeError("Either vocab or vocab_file must present")
+        return ''.join(sorted(c for c in set(vocab) if not c.isspace()))
+
+    @cached_property
+    def char_ids(self):
+        return {c: i for i, c in enumerate(self.chars)}
+
+    @cached_property
+    def counts(self):
+        return np.zeros(len(self.chars), dtype=np.int64)
+
+    @cached_property
+    def postings(self):
+        if self.index_file is not None and path.isfile(self.index_file):
+            with np.load(self.index_file) as data:
+                index = dict(data)
+            # Rebuilt if the texts or the options changed
+            if (index["num_lines"] == len(self.texts)
+                    and index["max_lines_per_char"] == self.max_lines_per_char
+                    and str(index["chars"]) == self.chars
+                    and index["sources"].tolist() == get_sources(self.texts)):
+                offsets, line_ids = index["offsets"], index["line_ids"]
+                return [line_ids[offsets[i]:offsets[i + 1]]
+                        for i in range(len(self.chars))]
+
+        postings = self.build()
+        if self.index_file is not None:
+            io = BytesIO()
+            np.savez(io,
+                     num_lines=np.array(len(self.texts)),
+                     max_lines_per_char=np.array(self.max_lines_per_char),
+                     chars=np.array(self.chars),
+                     sources=np.array(get_sources(self.texts), dtype=str),
+                     offsets=np.cumsum([0] + [len(p) for p in postings]),
+                     line_ids=np.concatenate(postings + [np.zeros(0, np.int64)]))
+            write_atomic(self.index_file, io.getvalue())
+        return postings
+
+    def build(self):
+        # A uniform reservoir of the lines of each character,
+        # with a fixed seed so that it is the same on every run
+        rng = random.Random(0)
+        n = self.max_lines_per_char
+        postings = [[] for _ in self.chars]
+        seen = [0] * len(self.chars)
+        for line_id, line in enumerate(tqdm(self.texts, desc="Indexing characters")):
+            # In order of appearance, the order of a set changes between runs
+            for c in dict.fromkeys(line):
+                i = self.char_ids.get(c, None)
+                if i is None:
+                    continue
+                if seen[i] < n:
+                    postings[i].append(line_id)
+                else:
+                    j = rng.randrange(seen[i] + 1)
+                    if j < n:
+                        postings[i][j] = line_id
+                seen[i] += 1
+        return [np.array(p, dtype=np.int64) for p in postings]
+
+    @cached_property
+    def indexed(self):
+        # Characters found in at least one line
+        return np.flatnonzero([len(p) > 0 for p in self.postings])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        text = self.sample(random)
+        self.emitted(text)
+        return text
+
+    def sample(self, rng):
+        indexed = self.indexed
+        if len(indexed) > 0 and rng.random() < self.balance:
+            counts = self.counts[indexed]
+            rarest = indexed[np.flatnonzero(counts == counts.min())]
+            line_id = int(rng.choice(self.postings[rng.choice(rarest)]))
+        else:
+            line_id = rng.randrange(len(self.texts))
+        return self.texts[line_id]
+
+    def emitted(self, text):
+        for c in text:
+            i = self.char_ids.get(c, None)
+            if i is not None:
+                self.counts[i] += 1
+
+
+def line_hash(line):
+    # 64 bit, as a compact key of the line
+    digest = blake2b(line.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+@dataclass
+class BucketedTexts:
+    """
+    Unique lines of `texts` (a sampler, or a file or directory read
+    with MmapTextFile or MmapTextDir), grouped by character length.
+
+    Lines are hashed and only the first line of every hash is kept,
+    `hashes` is the sorted array of the unique hashes, a compact hash
+    set for `line in self`. Bucket k holds the lines of length
+    `edges[k]` to `edges[k + 1] - 1`, the last one has no upper bound
+    and shorter lines than `edges[0]` are dropped. `sample(rng, bucket=k)`
+    is O(1). The index is kept in `index_file` if given, it is rebuilt
+    when the path, mtime or size of the files behind `texts` changed
+    (for plain samplers, only their length is checked).
+    """
+    texts: Any
+    edges: Tuple[int, ...] = (1, 8, 16, 32, 64, 128)
+    index_file: Optional[str] = None
+    encoding: str = 'utf-8'
+
+    def __post_init__(self):
+        if isinstance(self.texts, str) and path.isdir(self.texts):
+            self.texts = MmapTextDir(self.texts, encoding=self.encoding)
+        elif isinstance(self.texts, str):
+            self.texts = MmapTextFile(self.texts, self.encoding)
+        self.edges = tuple(self.edges)
+
+    @cached_property
+    def sources(self):
+        return get_sources(self.texts)
+
+    @cached_property
+    def index(self):
+        if self.index_file is not None and path.isfile(self.index_file):
+            with np.load(self.index_file) as data:
+                index = dict(data)
+            # Rebuilt if the texts or the buckets changed
+            if (index["num_lines"] == len(self.texts)
+                    and tuple(index["edges"].tolist()) == self.edges
+                    and index["sources"].tolist() == self.sources):
+                return index
+
+        index = self.build()
+        if self.index_file is not None:
+            io = BytesIO()
+            np.savez(io, **index)
+            write_atomic(self.index_file, io.getvalue())
+        return index
+
+    def build(self):
+        n = len(self.texts)
+        hashes = np.zeros(n, dtype=np.uint64)
+        lengths = np.zeros(n, dtype=np.int64)
+        for i in tqdm(range(n), desc="Hashing lines"):
+            line = self.texts[i]
+            hashes[i] = line_hash(line)
+            lengths[i] = len(line)
+
+        # np.unique gives the first line of every hash
+        unique_hashes, line_ids = np.unique(hashes, return_index=True)
+        buckets = np.searchsorted(self.edges, lengths[line_ids], side="right") - 1
+        keep = buckets >= 0
+        line_ids, buckets = line_ids[keep], buckets[keep]
+        order = np.argsort(buckets, kind="stable")
+        counts = np.bincount(buckets, minlength=len(self.edges))
+        return dict(
+            num_lines=np.array(n),
+            edges=np.array(self.edges),
+            sources=np.array(self.sources, dtype=str),
+            hashes=unique_hashes,
+            line_ids=line_ids[order].astype(np.uint64),
+            offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.uint64),
+        )
+
+    @property
+    def hashes(self):
+        return self.index["hashes"]
+
+    def __contains__(self, line):
+        h = np.uint64(line_hash(line))
+        i = np.searchsorted(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def get_bucket(self, length):
+        return int(np.searchsorted(self.edges, length, side="right")) - 1
+
+    def bucket_size(self, bucket):
+        offsets = self.index["offsets"]
+        return int(offsets[bucket + 1] - offsets[bucket])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self.index["line_ids"])
+
+    def __getitem__(self, i):
+        # Ordered by bucket
+        return self.texts[int(self.index["line_ids"][i])]
+
+    def sample(self, rng, bucket=None):
+        # None if the bucket is empty
+        if bucket is None:
+            return self[rng.randrange(len(self))]
+        start = int(self.index["offsets"][bucket])
+        size = self.bucket_size(bucket)
+        if size == 0:
+            return None
+        return self[start + rng.randrange(size)]
+
+
 @dataclass
 class LongTextFile:
+    """
+    Pieces of `min_length` to `max_length` characters from the lines
+    of a large file, read in blocks of `block_size` bytes.
+
+    Each process starts at the first line after a random byte offset,
+    taken from the first index it is asked for, and reads on, wrapping
+    at the end of the file. After a whole file of reading, the next
+    index gives a new offset.
+    """
     file: str
     min_length: int
     max_length: int
     encoding: str = 'utf-8'
     delim: str = '\n'
+    block_size: int = 2**20
 
-    @cached_property
-    def queue(self):
-        from queue import Queue
-        return Queue()
+    def __post_init__(self):
+        self.reset()
+
+    def reset(self):
+        self.io = None
+        self.pid = None
+        self.pieces = []
+        self.position = 0
+        self.offset = 0
+        self.remaining = 0
+
+    def __getstate__(self):
+        # Every process opens the file and seeks on its own
+        state = dict(self.__dict__)
+        state.update(io=None, pid=None, pieces=[], position=0)
+        return state
 
     @cached_property
-    def io(self):
-        return open(self.file, self.encoding)
+    def size(self):
+        return path.getsize(self.file)
 
     def __len__(self):
-        return 1000000
-
-    def __getitem__(self, i):
-        while self.queue.qsize() == 0:
-            line = self.io.readline()
-            if line == '':
-                reset = True
-                for i in range(5):
-                    line = self.io.readline()
-                    if line != '':
-                        reset = False
-                        break
-                if reset:
-                    self.io.seek(0)
-                    line = self.io.readline()
+        return max(self.size, 1)
+
+    def seek(self, offset):
+        # To the first line starting at or after `offset`
+        self.io.seek(max(offset - 1, 0))
+        if offset > 0:
+            self.io.readline()
+        self.offset = self.io.tell()
+        self.remaining = self.size
+
+    def read_block(self):
+        if self.offset >= self.size:
+            self.offset = 0
+        self.io.seek(self.offset)
+        block = self.io.read(self.block_size)
+
+        # The last, incomplete line is left for the next block,
+        # a line longer than the block is read up to its end,
+        # so that blocks never end inside a character
+        end = block.rfind(b"\n") + 1
+        if self.offset + len(block) < self.size:
+            if end > 0:
+                block = block[:end]
+            else:
+                block += self.io.readline()
+        self.offset += len(block)
+        self.remaining -= len(block)
+
+        pieces = []
+        text = block.decode(self.encoding, errors="replace")
+        for line in text.split(self.delim):
             line = line.replace("\t", " ").replace("\n", " ").strip()
-            splits = max_size_split(line, self.min_length, self.max_length)
-            for split in splits:
-                split = split.strip()
-                if len(split) == 0:
-                    continue
-                self.queue.put(split)
+            if len(line) == 0:
+                continue
+            for piece in max_size_split(line, self.min_length, self.max_length):
+                piece = piece.strip()
+                if len(piece) > 0:
+                    pieces.append(piece)
+        return pieces
 
-        s = self.queue.get()
-        return s
+    def __getitem__(self, i):
+        if self.pid != getpid():
+            self.reset()
+            self.io = open(self.file, "rb")
+            self.pid = getpid()
+            self.seek(i % len(self))
+
+        empty_reads = 0
+        while self.position >= len(self.pieces):
+            if self.remaining <= 0:
+                self.seek(i % len(self))
+            self.pieces = self.read_block()
+            self.position = 0
+            # Blank files would be read forever
+            empty_reads = empty_reads + 1 if len(self.pieces) == 0 else 0
+            if empty_reads * self.block_size > 2 * self.size + self.block_size:
+                raise RuntimeError(f"{self.file} has no text")
+
+        piece = self.pieces[self.position]
+        self.position += 1
+        return piece
 
 
 def max_size_split(line, a, b):
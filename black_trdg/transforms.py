@@ -1,147 +1,567 @@
-from PIL import Image, ImageFilter, ImageChops
-from typing import Callable, List, Tuple
+from PIL import Image
+from typing import Callable, List, Tuple, Optional
 from PIL.Image import Resampling
 from dataclasses import dataclass
+from math import ceil, floor
+from functools import partial, wraps
+from threading import Thread
 import numpy as np
 import random
 import cv2
 
+from . import matrices
+from .samplers.base import numpy_rng
+
+
+# Transforms work either on PIL images or on uint8 arrays of shape
+# (H, W) or (H, W, C), which is declared by their `kind`: "pil",
+# "array", or "any" for the transforms that combine other transforms.
+# `apply` takes and returns the transform's own kind, calling a
+# transform converts from and back to the kind it is given.
+# Random draws come from the `rng` argument, a `random.Random`
+# or the `random` module itself, so that a sample can be replayed.
+
+@dataclass
+class ConversionStats:
+    calls: int = 0
+    conversions: int = 0
+    nbytes: int = 0
+
+    @property
+    def conversions_per_call(self):
+        return self.conversions / max(self.calls, 1)
+
+    @property
+    def nbytes_per_call(self):
+        return self.nbytes / max(self.calls, 1)
+
+
+# Every PIL <-> array conversion in this process
+conversion_stats = ConversionStats()
+
+
+def to_array(image):
+    if image.mode not in ("L", "LA", "RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    np_image = np.asarray(image)
+    conversion_stats.conversions += 1
+    conversion_stats.nbytes += np_image.nbytes
+    return np_image
+
+
+def to_pil(np_image):
+    if np_image.ndim == 3 and np_image.shape[2] == 1:
+        np_image = np_image[..., 0]
+    conversion_stats.conversions += 1
+    conversion_stats.nbytes += np_image.nbytes
+    return Image.fromarray(np_image)
+
+
+def get_kind(image):
+    return "array" if isinstance(image, np.ndarray) else "pil"
+
+
+def get_size(image):
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+def convert(image, kind):
+    if kind == "any" or kind == get_kind(image):
+        return image
+    if kind == "array":
+        return to_array(image)
+    return to_pil(image)
+
+
+def apply_transform(t, image, rng=random):
+    # Run `t` on its own kind, plain callables take PIL images
+    if isinstance(t, Transform):
+        return t.apply(convert(image, t.kind), rng)
+    return t(convert(image, "pil"))
+
+
+def call_transform(t, image, rng=random):
+    # Plain callables can not be given the random generator
+    if isinstance(t, Transform):
+        return t(image, rng)
+    return t(image)
+
+
+def accepts_pil(function):
+    # Array functions that also take PIL images, and then return PIL images
+    @wraps(function)
+    def wrapper(image, *args, **kwargs):
+        if isinstance(image, np.ndarray):
+            return function(image, *args, **kwargs)
+        return to_pil(function(to_array(image), *args, **kwargs))
+    return wrapper
+
+
+def writable(np_image):
+    # Array transforms work in place when they can
+    if np_image.flags.writeable:
+        return np_image
+    return np_image.copy()
+
+
+class Transform:
+    kind = "pil"
+
+    def apply(self, image, rng=random):
+        raise NotImplementedError
+
+    @property
+    def stats(self):
+        # Conversions made by the calls of this transform
+        if "_stats" not in self.__dict__:
+            self._stats = ConversionStats()
+        return self._stats
+
+    def __call__(self, image, rng=random):
+        conversions = conversion_stats.conversions
+        nbytes = conversion_stats.nbytes
+        output = convert(self.apply(convert(image, self.kind), rng), get_kind(image))
+        self.stats.calls += 1
+        self.stats.conversions += conversion_stats.conversions - conversions
+        self.stats.nbytes += conversion_stats.nbytes - nbytes
+        return output
+
 
 def rotate(image, degree):
     return image.rotate(degree, expand=True, resample=Resampling.BILINEAR)
 
 
-def gaussian_blur(image, radius):
-    kernel = ImageFilter.GaussianBlur(radius=radius)
-    return image.filter(kernel)
+@accepts_pil
+def filter_image(np_image, kernel):
+    # `kernel` is either a 2-D kernel, or a pair of 1-D
+    # (horizontal, vertical) kernels of a separable filter
+    if isinstance(kernel, tuple):
+        kx, ky = kernel
+        return cv2.sepFilter2D(np_image, -1, kx, ky,
+                               borderType=cv2.BORDER_REPLICATE)
+    else:
+        return cv2.filter2D(np_image, -1, kernel,
+                            borderType=cv2.BORDER_REPLICATE)
+
+
+def box_kernel(radius):
+    # 1-D box of width 2 * radius + 1, the ends are
+    # weighted down for fractional radius, like ImageFilter.BoxBlur
+    n = ceil(radius)
+    kernel = np.ones(2 * n + 1, dtype=np.float32)
+    kernel[[0, -1]] = radius - n + 1
+    return kernel / kernel.sum()
+
+
+def motion_kernel(size, angle=0):
+    # A line of `size` pixels through the center,
+    # 0 degree is horizontal, 90 degree is vertical
+    kernel = np.zeros((size, size), dtype=np.float32)
+    kernel[(size - 1) // 2, :] = 1
+    if angle % 180 != 0:
+        center = ((size - 1) / 2, (size - 1) / 2)
+        rotation = cv2.getRotationMatrix2D(center, angle, 1)
+        kernel = cv2.warpAffine(kernel, rotation, (size, size))
+    return kernel / kernel.sum()
+
+
+def combine_kernels(kernels):
+    # Convolving with each kernel in turn is the same as
+    # convolving once with their (full) convolution
+    kernel = kernels[0]
+    for k in kernels[1:]:
+        h, w = kernel.shape
+        combined = np.zeros((h + k.shape[0] - 1, w + k.shape[1] - 1),
+                            dtype=np.float32)
+        for (y, x), v in np.ndenumerate(k):
+            combined[y:y + h, x:x + w] += v * kernel
+        kernel = combined
+    return kernel
+
+
+@accepts_pil
+def gaussian_blur(np_image, radius):
+    return cv2.GaussianBlur(np_image, (0, 0), radius,
+                            borderType=cv2.BORDER_REPLICATE)
 
 
 def box_blur(image, radius):
-    kernel = ImageFilter.BoxBlur(radius=radius)
-    return image.filter(kernel)
+    kernel = box_kernel(radius)
+    return filter_image(image, (kernel, kernel))
+
 
+def motion_blur(image, size, vertical=True, angle=None):
+    if angle is not None:
+        return filter_image(image, motion_kernel(size, angle))
 
-def motion_blur(image, size, vertical=True):
-    kernel_motion_blur = np.zeros((size, size))
+    line = np.full(size, 1 / size, dtype=np.float32)
+    point = np.ones(1, dtype=np.float32)
     if vertical:
-        kernel_motion_blur[:, int((size-1)/2)] = np.ones(size)
+        return filter_image(image, (point, line))
     else:
-        kernel_motion_blur[int((size-1)/2), :] = np.ones(size)
-    kernel_motion_blur = kernel_motion_blur / size
-    kernel = ImageFilter.Kernel(
-        (size, size),
-        kernel_motion_blur.flatten().tolist()
+        return filter_image(image, (line, point))
+
+
+@accepts_pil
+def padding(np_image, x1, y1, x2, y2):
+    pads = [(y1, y2), (x1, x2)] + [(0, 0)] * (np_image.ndim - 2)
+    return np.pad(np_image, pads, 'constant')
+
+
+def expand(matrix, size, linear):
+    # Apply `linear` around the center of the current canvas and
+    # grow the canvas to fit the result, like rotate(expand=True)
+    w, h = size
+    corners = linear @ np.array([[-w, w, -w, w],
+                                 [-h, -h, h, h],
+                                 [2, 2, 2, 2]]) / 2
+    new_w = ceil(corners[0].max()) - floor(corners[0].min())
+    new_h = ceil(corners[1].max()) - floor(corners[1].min())
+    matrix = matrices.compose([
+        matrices.translate(new_w / 2, new_h / 2),
+        linear,
+        matrices.translate(-w / 2, -h / 2),
+        matrix,
+    ])
+    return matrix, (new_w, new_h)
+
+
+@accepts_pil
+def warp(np_image, matrix, size):
+    # One resampling for the whole composed transformation
+    if size == get_size(np_image) and np.allclose(matrix, np.eye(3)):
+        return np_image
+    return cv2.warpAffine(
+        np_image,
+        matrix[:2].astype(np.float64),
+        size,
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=0,
     )
-    result = image.filter(kernel)
-    return result
 
 
-def padding(image, x1, y1, x2, y2):
-    np_image = np.array(image)
-    np_image = np.pad(np_image, [(y1, y2), (x1, x2), (0, 0)], 'constant')
-    image = Image.fromarray(np_image)
-    return image
+class Geometric(Transform):
+    """
+    Geometric transforms describe themselves with `update(matrix, size, rng)`,
+    which returns the 3x3 matrix and canvas size after the transformation,
+    so that chains of them can be applied with one `warp`.
+    """
+    kind = "array"
+
+    def apply(self, image, rng=random):
+        matrix, size = self.update(np.eye(3), get_size(image), rng)
+        return warp(image, matrix, size)
 
 
 @dataclass
-class RandomMotionBlur:
+class RandomMotionBlur(Transform):
     sizes: Tuple[int] = (3, 5)
     n_applies: Tuple[int] = (1, 2, 3)
-
-    def __call__(self, image):
-        size = random.choice(self.sizes)
-        for i in range(random.choice(self.n_applies)):
-            if random.choice([True, False]):
-                image = motion_blur(image, size, vertical=True)
-            if random.choice([True, False]):
-                image = motion_blur(image, size, vertical=False)
-        return image
+    angles: Optional[Tuple[float, float]] = None
+    kind = "array"
+
+    def apply(self, image, rng=random):
+        # All the passes are combined into a single kernel
+        size = rng.choice(self.sizes)
+        kernels = []
+        for i in range(rng.choice(self.n_applies)):
+            if self.angles is not None:
+                kernels.append(motion_kernel(size, rng.uniform(*self.angles)))
+                continue
+            if rng.choice([True, False]):
+                kernels.append(motion_kernel(size, 90))
+            if rng.choice([True, False]):
+                kernels.append(motion_kernel(size, 0))
+        if len(kernels) == 0:
+            return image
+        return filter_image(image, combine_kernels(kernels))
 
 
 @dataclass
-class RandomPadding:
+class RandomPadding(Geometric):
     def __init__(self, x1, y1=None, x2=None, y2=None):
         self.x1 = x1
         self.y1 = y1 if y1 is not None else x1
         self.y2 = y2 if y2 is not None else x1
         self.x2 = x2 if x2 is not None else x1
 
-    def __call__(self, image):
-        x1 = random.randint(*self.x1)
-        x2 = random.randint(*self.x2)
-        y1 = random.randint(*self.y1)
-        y2 = random.randint(*self.y2)
+    def apply(self, image, rng=random):
+        x1 = rng.randint(*self.x1)
+        x2 = rng.randint(*self.x2)
+        y1 = rng.randint(*self.y1)
+        y2 = rng.randint(*self.y2)
         return padding(image, x1, y1, x2, y2)
 
+    def update(self, matrix, size, rng=random):
+        x1 = rng.randint(*self.x1)
+        x2 = rng.randint(*self.x2)
+        y1 = rng.randint(*self.y1)
+        y2 = rng.randint(*self.y2)
+        w, h = size
+        matrix = matrices.compose([matrices.translate(x1, y1), matrix])
+        return matrix, (w + x1 + x2, h + y1 + y2)
+
 
 @dataclass
-class RandomGaussianBlur:
+class PadToAspect(Transform):
+    """
+    Pad with zeros to a width / height ratio of `aspect`, at a random
+    horizontal position, or centered vertically if the image is wider.
+    """
+    aspect: float
+    kind = "array"
+
+    def apply(self, image, rng=random):
+        height, width = image.shape[:2]
+        target_width = round(height * self.aspect)
+        if width < target_width:
+            x1 = rng.randint(0, target_width - width)
+            return padding(image, x1, 0, target_width - width - x1, 0)
+        target_height = round(width / self.aspect)
+        if height < target_height:
+            y1 = (target_height - height) // 2
+            return padding(image, 0, y1, 0, target_height - height - y1)
+        return image
+
+
+@dataclass
+class RandomGaussianBlur(Transform):
     min_radius: float = 1
     max_radius: float = 2
+    kind = "array"
 
-    def __call__(self, image):
-        radius = random.choice(
-            np.arange(self.min_radius, self.max_radius, 0.01))
+    def apply(self, image, rng=random):
+        radius = rng.uniform(self.min_radius, self.max_radius)
         return gaussian_blur(image, radius)
 
 
 @dataclass
-class RandomBoxBlur:
+class RandomBoxBlur(Transform):
     min_radius: float = 1
     max_radius: float = 2
+    kind = "array"
 
-    def __call__(self, image):
-        radius = random.choice(
-            np.arange(self.min_radius, self.max_radius, 0.01))
+    def apply(self, image, rng=random):
+        radius = rng.uniform(self.min_radius, self.max_radius)
         return box_blur(image, radius)
 
 
 @dataclass
-class RandomRotate:
+class RandomRotate(Geometric):
     min_degree: int = -3
     max_degree: int = 3
+    kind = "pil"
 
-    def __call__(self, image):
-        degree = random.randint(self.min_degree, self.max_degree)
+    def apply(self, image, rng=random):
+        degree = rng.randint(self.min_degree, self.max_degree)
         # NEAREST IS NOT ENOUGH
         # TEXT IMAGE WILL BE BROKEN BY THE ROTATION
         return rotate(image, degree)
 
+    def update(self, matrix, size, rng=random):
+        # Counter clockwise like PIL, the y axis points down
+        degree = rng.randint(self.min_degree, self.max_degree)
+        return expand(matrix, size, matrices.rotate(-degree))
+
+
+@dataclass
+class RandomShear(Geometric):
+    min_degree: float = -10
+    max_degree: float = 10
+    vertical: bool = False
+
+    def update(self, matrix, size, rng=random):
+        degree = rng.uniform(self.min_degree, self.max_degree)
+        if self.vertical:
+            return expand(matrix, size, matrices.sheary(degree))
+        return expand(matrix, size, matrices.shearx(degree))
+
+
+@dataclass
+class RandomScale(Geometric):
+    min_ratio: float = 0.8
+    max_ratio: float = 1.2
+    keep_aspect: bool = True
+
+    def update(self, matrix, size, rng=random):
+        rx = rng.uniform(self.min_ratio, self.max_ratio)
+        ry = rx if self.keep_aspect else rng.uniform(self.min_ratio, self.max_ratio)
+        return expand(matrix, size, matrices.scale(rx, ry))
+
+
+# Signed noise is stored as two uint8 arrays (positive and negative parts)
+# in units of 1 / NOISE_SCALE, so that it is added with saturation by OpenCV
+NOISE_SCALE = 32
+
+
+def split_signed(noise):
+    noise = noise * NOISE_SCALE
+    positive = np.clip(noise, 0, 255).astype(np.uint8)
+    negative = np.clip(-noise, 0, 255).astype(np.uint8)
+    return positive, negative
+
+
+def gaussian_noise(rng, size):
+    # Gray noise, the same on every channel
+    noise = rng.standard_normal((size, size, 1), dtype=np.float32)
+    return split_signed(np.repeat(noise, 3, axis=2))
+
+
+def low_frequency_noise(patch_size, rng, size):
+    # Gaussian noise on a grid of patch_size, smoothly upsampled
+    n = size // patch_size + 2
+    noise = rng.standard_normal((n, n), dtype=np.float32)
+    noise = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+    return split_signed(np.repeat(noise[..., None], 3, axis=2))
+
+
+def uniform_noise(rng, size):
+    return (rng.integers(0, 2**16, (size, size), dtype=np.uint16),)
+
+
+class NoiseBank:
+    """
+    Pre-generated noise arrays, random crops of them are used
+    instead of drawing new noise for every image.
+
+    `make(rng, size)` returns a tuple of noise arrays. If `refresh_every`
+    is set, new arrays are made in a background thread every
+    `refresh_every` crops, samples are then no longer reproducible.
+    """
+
+    def __init__(self, make, size=512, seed=0, refresh_every=None):
+        self.make = make
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.refresh_every = refresh_every
+        self.arrays = make(self.rng, size)
+        self.count = 0
+        self.thread = None
+
+    def refresh(self):
+        self.arrays = self.make(self.rng, self.size)
+
+    def crop(self, height, width, rng=random):
+        self.count += 1
+        if self.refresh_every is not None and self.count % self.refresh_every == 0:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.refresh, daemon=True)
+                self.thread.start()
+
+        arrays = self.arrays
+        y, x = numpy_rng(rng).integers(0, [self.size - height + 1,
+                                           self.size - width + 1])
+        return [array[y:y + height, x:x + width] for array in arrays]
+
+    def tiles(self, np_image, rng=random):
+        # Views of the image no larger than the bank, with their noise
+        rng = numpy_rng(rng)
+        height, width = np_image.shape[:2]
+        for y in range(0, height, self.size):
+            for x in range(0, width, self.size):
+                view = np_image[y:y + self.size, x:x + self.size]
+                yield view, self.crop(*view.shape[:2], rng)
+
+
+def rgb_array(np_image):
+    # Writable RGB version of the image, like image.convert("RGB")
+    if np_image.ndim == 2:
+        return cv2.cvtColor(np_image, cv2.COLOR_GRAY2RGB)
+    if np_image.shape[2] != 3:
+        return np.ascontiguousarray(np_image[..., :3])
+    return writable(np_image)
+
 
 @dataclass
-class GaussianNoise:
+class GaussianNoise(Transform):
     sigma: Tuple[int, int] = (1, 10)
+    level: Tuple[float, float] = (0.7, 0.9)
+    bank_size: int = 512
+    refresh_every: Optional[int] = None
+    kind = "array"
+
+    def __post_init__(self):
+        self.bank = NoiseBank(gaussian_noise, self.bank_size,
+                              refresh_every=self.refresh_every)
+
+    def apply(self, image, rng=random):
+        # Blend with gray noise: (1 - level) * image + level * (128 + sigma * z)
+        sigma = rng.randint(*self.sigma)
+        level = rng.uniform(*self.level)
+        scale = level * sigma / NOISE_SCALE
+        np_image = rgb_array(image)
+        for view, (positive, negative) in self.bank.tiles(np_image, rng):
+            cv2.addWeighted(view, 1 - level, positive, scale, 128 * level, dst=view)
+            cv2.addWeighted(view, 1, negative, -scale, 0, dst=view)
+        return np_image
 
-    def __call__(self, image):
-        sigma = random.randint(*self.sigma)
-        level = 1 - random.choice(np.arange(0.1, 0.3, 0.01).tolist())
-        noise = Image.effect_noise(image.size, sigma).convert("RGB")
-        image = ImageChops.blend(image.convert("RGB"), noise, level)
-        return image
 
+@dataclass
+class PatchedNoise(Transform):
+    sigma: Tuple[int, int] = (5, 30)
+    patch_size: int = 16
+    bank_size: int = 512
+    refresh_every: Optional[int] = None
+    kind = "array"
+
+    def __post_init__(self):
+        make = partial(low_frequency_noise, self.patch_size)
+        self.bank = NoiseBank(make, self.bank_size,
+                              refresh_every=self.refresh_every)
+
+    def apply(self, image, rng=random):
+        # Add smooth, low frequency noise: image + sigma * z
+        scale = rng.randint(*self.sigma) / NOISE_SCALE
+        np_image = rgb_array(image)
+        for view, (positive, negative) in self.bank.tiles(np_image, rng):
+            cv2.addWeighted(view, 1, positive, scale, 0, dst=view)
+            cv2.addWeighted(view, 1, negative, -scale, 0, dst=view)
+        return np_image
+
+
+@dataclass
+class SaltPepperNoise(Transform):
+    amount: Tuple[float, float] = (0.001, 0.02)
+    bank_size: int = 512
+    refresh_every: Optional[int] = None
+    kind = "array"
+
+    def __post_init__(self):
+        self.bank = NoiseBank(uniform_noise, self.bank_size,
+                              refresh_every=self.refresh_every)
+
+    def apply(self, image, rng=random):
+        threshold = int(rng.uniform(*self.amount) / 2 * 2**16)
+        np_image = writable(image)
+        for view, (uniform,) in self.bank.tiles(np_image, rng):
+            view[uniform < threshold] = 0
+            view[uniform >= 2**16 - threshold] = 255
+        return np_image
 
-# TODO: just do it
-# def patched_gaussian_noise(image, patch_size):
-#     w, h = image.size
-#     nw = w//self.patch_size
-#     nh = h//self.patch_size
-#     noise = np.random.randn(nw, nh, image.getchannels())
-#     noise = (noise * 255).round().astype('uint8')
 
+# The combining transforms pass the image along in whatever kind
+# the last transform returned, so it is only converted when
+# the next transform needs the other kind
 
 @ dataclass
-class Sometime:
+class Sometime(Transform):
     t: Callable
     p: float = 0.5
+    kind = "any"
 
-    def __call__(self, image):
-        if random.random() < self.p:
-            return self.t(image)
+    def apply(self, image, rng=random):
+        if rng.random() < self.p:
+            return apply_transform(self.t, image, rng)
         else:
             return image
 
 
-class RandomApply:
+class RandomApply(Transform):
+    kind = "any"
+
     def __init__(self, ts: List[Callable], ps=None):
         if ps == None:
             ps = [0.5 for _ in ts]
@@ -150,17 +570,39 @@ class RandomApply:
         self.ts = ts
         self.ps = ps
 
-    def __call__(self, image):
+    def apply(self, image, rng=random):
         for t, p in zip(self.ts, self.ps):
-            if random.random() < p:
-                image = t(image)
+            if rng.random() < p:
+                image = apply_transform(t, image, rng)
         return image
 
 
+class RandomGeometric(Geometric):
+    """
+    Like RandomApply, but for Geometric transforms: their matrices
+    are composed and the image is resampled only once.
+    """
+
+    def __init__(self, ts: List[Geometric], ps=None):
+        if ps == None:
+            ps = [0.5 for _ in ts]
+
+        assert len(ps) == len(ts)
+        self.ts = ts
+        self.ps = ps
+
+    def update(self, matrix, size, rng=random):
+        for t, p in zip(self.ts, self.ps):
+            if rng.random() < p:
+                matrix, size = t.update(matrix, size, rng)
+        return matrix, size
+
+
 @dataclass
-class OneOf:
+class OneOf(Transform):
     transformations: List
+    kind = "any"
 
-    def __call__(self, image):
-        transform = random.choice(self.transformations)
-        return transform(image)
+    def apply(self, image, rng=random):
+        transform = rng.choice(self.transformations)
+        return apply_transform(transform, image, rng)
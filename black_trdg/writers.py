@@ -0,0 +1,354 @@
+from os import path, fsync, replace, remove, makedirs
+from functools import partial
+from io import BytesIO
+from traceback import print_exc
+from PIL import Image
+import numpy as np
+import tarfile
+import json
+
+
+def write_atomic(file, data: bytes):
+    # Write to a hidden temporary file, then rename,
+    # so that `file` is either complete or missing
+    tmp_file = path.join(path.dirname(file), "." + path.basename(file))
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        fsync(f.fileno())
+    replace(tmp_file, file)
+
+
+class AnnotationWriter:
+    """
+    Append-only annotation file.
+
+    Records are buffered and written every `flush_every` records,
+    every `checkpoint_every` records the file is fsync-ed and the
+    next sample index is committed to `<file>.checkpoint`.
+
+    With `resume=True`, the annotation file is truncated to the last
+    checkpoint and `self.start` is the index to resume generating from.
+    The checkpoint also records the generator's `seed`, samples past
+    it are only the same again with the same seed: a resumed run takes
+    the recorded seed, and refuses a different one. Without a seed,
+    one is drawn the same way as Generator does.
+    """
+
+    def __init__(self, file, flush_every=1000, checkpoint_every=100_000,
+                 resume=False, seed=None):
+        self.file = file
+        self.checkpoint_file = file + ".checkpoint"
+        self.flush_every = flush_every
+        self.checkpoint_every = checkpoint_every
+        self.buffer = []
+        self.uncommitted = 0
+
+        self.start, offset = 0, 0
+        if resume and path.isfile(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            self.start, offset = checkpoint["index"], checkpoint["offset"]
+            saved_seed = checkpoint.get("seed", None)
+            if saved_seed is None:
+                raise ValueError(f"{self.checkpoint_file} has no seed, can't resume")
+            if seed is not None and seed != saved_seed:
+                raise ValueError(f"Resuming with seed {seed}, "
+                                 f"the run was started with seed {saved_seed}")
+            seed = saved_seed
+        elif path.isfile(self.checkpoint_file):
+            remove(self.checkpoint_file)
+
+        # Drop anything written after the last checkpoint
+        self.io = open(file, "ab")
+        self.io.truncate(offset)
+        self.io.seek(offset)
+        self.index = self.start
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+
+        # Recorded right away, a run can't be resumed with another seed
+        self.checkpoint()
+
+    def write(self, idx, line):
+        # A None line marks a failed sample, only the index is advanced
+        if line is not None:
+            self.buffer.append(line + "\n")
+        self.index = idx + 1
+        self.uncommitted += 1
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+        if self.uncommitted >= self.checkpoint_every:
+            self.checkpoint()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.io.write("".join(self.buffer).encode("utf-8"))
+            self.buffer = []
+        self.io.flush()
+
+    def checkpoint(self):
+        self.flush()
+        fsync(self.io.fileno())
+        checkpoint = dict(index=self.index, offset=self.io.tell(), seed=self.seed)
+        write_atomic(self.checkpoint_file, json.dumps(checkpoint).encode())
+        self.uncommitted = 0
+
+    def close(self):
+        if self.io.closed:
+            return
+        self.checkpoint()
+        self.io.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_format(ext):
+    return Image.registered_extensions()["." + ext]
+
+
+def save_image_file(output_path, image_dir, ext, idx, image, text):
+    name = path.join(image_dir, f"{idx + 1:09d}.{ext}")
+    out_path = path.join(output_path, name)
+    try:
+        # Images are renamed into place once complete, existing ones
+        # are always overwritten: past a checkpoint, they may not match
+        # the new labels (samplers that are not index-pure)
+        tmp_path = path.join(output_path, image_dir, "." + path.basename(name))
+        image.save(tmp_path)
+        replace(tmp_path, out_path)
+        return f"{name}\t{text}"
+    except ValueError:
+        print(f"Can't save {text!r}")
+        print_exc()
+
+
+def encode_image(ext, idx, image, text):
+    io = BytesIO()
+    try:
+        image.save(io, format=get_format(ext))
+        return io.getvalue(), text
+    except ValueError:
+        print(f"Can't save {text!r}")
+        print_exc()
+
+
+class FileOutput:
+    """
+    One image file per sample in `image_dir` and an `annotations.txt`.
+    Images already in `image_dir` are overwritten, also when resuming.
+    """
+
+    def __init__(self, output_path, image_dir="images", ext="jpg",
+                 resume=False, **annotation_options):
+        makedirs(path.join(output_path, image_dir), exist_ok=True)
+        self.annotations = AnnotationWriter(
+            path.join(output_path, "annotations.txt"),
+            resume=resume,
+            **annotation_options
+        )
+        self.start = self.annotations.start
+        self.seed = self.annotations.seed
+        self.consume = partial(save_image_file, output_path, image_dir, ext)
+
+    def write(self, idx, record):
+        self.annotations.write(idx, record)
+
+    def close(self):
+        self.annotations.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TarOutput:
+    """
+    WebDataset-style shards, `shard-000000.tar`, `shard-000001.tar`...
+    Each sample is stored as `<index>.<ext>` followed by `<index>.txt`.
+    """
+    start = 0
+
+    def __init__(self, output_path, shard_size=10000, ext="jpg"):
+        makedirs(output_path, exist_ok=True)
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.ext = ext
+        self.consume = partial(encode_image, ext)
+        self.tar = None
+        self.num_shards = 0
+        self.shard_count = 0
+
+    def next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        file = path.join(self.output_path, f"shard-{self.num_shards:06d}.tar")
+        self.tar = tarfile.open(file, "w")
+        self.num_shards += 1
+        self.shard_count = 0
+
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, BytesIO(data))
+
+    def write(self, idx, record):
+        if record is None:
+            return
+        if self.tar is None or self.shard_count >= self.shard_size:
+            self.next_shard()
+        image, text = record
+        self.add(f"{idx:09d}.{self.ext}", image)
+        self.add(f"{idx:09d}.txt", text.encode("utf-8"))
+        self.shard_count += 1
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def encode_bucketed(ext, idx, image, text):
+    # The width tells BucketedOutput which shards the sample goes to
+    record = encode_image(ext, idx, image, text)
+    if record is not None:
+        return (image.width, *record)
+
+
+class BucketedOutput:
+    """
+    TarOutput shards per width bucket, in `w<width>/` subdirectories,
+    for samples of a few fixed shapes (see Generator's `bucket_widths`).
+    Loading one directory at a time gives batches of a single shape.
+    """
+    start = 0
+
+    def __init__(self, output_path, shard_size=10000, ext="jpg"):
+        makedirs(output_path, exist_ok=True)
+        self.output_path = output_path
+        self.shard_size = shard_size
+        self.ext = ext
+        self.consume = partial(encode_bucketed, ext)
+        self.buckets = {}
+
+    def write(self, idx, record):
+        if record is None:
+            return
+        width, image, text = record
+        bucket = self.buckets.get(width, None)
+        if bucket is None:
+            bucket = self.buckets[width] = TarOutput(
+                path.join(self.output_path, f"w{width}"),
+                shard_size=self.shard_size,
+                ext=self.ext,
+            )
+        bucket.write(idx, (image, text))
+
+    def close(self):
+        for bucket in self.buckets.values():
+            bucket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_tar_shards(files):
+    """
+    Read (image bytes, text) pairs sequentially from TarOutput shards.
+    """
+    for file in files:
+        with tarfile.open(file) as tar:
+            image = None
+            for member in tar:
+                data = tar.extractfile(member).read()
+                if member.name.endswith(".txt"):
+                    yield image, data.decode("utf-8")
+                else:
+                    image = data
+
+
+class PackedOutput:
+    """
+    All samples in one `<name>.bin` file, with an `<name>.idx` index.
+
+    The index is a flat uint64 array of (sample index, offset,
+    image size, text size) rows, pointing into the data file where
+    the encoded image is directly followed by the utf-8 text.
+    Read with `PackedReader`.
+    """
+    start = 0
+
+    def __init__(self, output_path, name="samples", ext="jpg"):
+        makedirs(output_path, exist_ok=True)
+        self.consume = partial(encode_image, ext)
+        self.data = open(path.join(output_path, name + ".bin"), "wb")
+        self.index = open(path.join(output_path, name + ".idx"), "wb")
+        self.offset = 0
+
+    def write(self, idx, record):
+        if record is None:
+            return
+        image, text = record
+        text = text.encode("utf-8")
+        self.data.write(image)
+        self.data.write(text)
+        row = np.array([idx, self.offset, len(image), len(text)], dtype=np.uint64)
+        self.index.write(row.tobytes())
+        self.offset += len(image) + len(text)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PackedReader:
+    """
+    Random access to the samples of a PackedOutput,
+    `reader[i]` returns the encoded image bytes and the text.
+    """
+
+    def __init__(self, output_path, name="samples"):
+        self.index = np.fromfile(path.join(output_path, name + ".idx"),
+                                 dtype=np.uint64).reshape(-1, 4)
+        data_file = path.join(output_path, name + ".bin")
+        if len(self.index) > 0:
+            self.data = np.memmap(data_file, dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        _, offset, image_size, text_size = self.index[i].tolist()
+        image = self.data[offset:offset + image_size].tobytes()
+        offset = offset + image_size
+        text = self.data[offset:offset + text_size].tobytes()
+        return image, text.decode("utf-8")
+
+
+outputs = dict(files=FileOutput, tar=TarOutput, packed=PackedOutput,
+               buckets=BucketedOutput)
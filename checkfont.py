@@ -1,6 +1,4 @@
-from fontTools.ttLib import TTFont
-from fontTools.unicode import Unicode
-import sys
+from black_trdg.coverage import CoverageIndex
 from argparse import ArgumentParser
 from os import path
 import os
@@ -8,6 +6,8 @@ import os
 parser = ArgumentParser()
 parser.add_argument("--vocab", "-c", required=True)
 parser.add_argument("-r", help="Output font file only", default=False, dest="raw_output", action="store_true")
+parser.add_argument("--index", default=None,
+                    help="Coverage index file, the same as FontPool's coverage_file")
 parser.add_argument("font")
 args = parser.parse_args()
 
@@ -20,19 +20,9 @@ with open(args.vocab) as f:
     vocab = f.read().replace("\n", "")
 
 
-def has_glyph(font, glyph):
-    for table in font['cmap'].tables:
-        if ord(glyph) in table.cmap.keys():
-            return True
-    return False
-
-
-for font_file in args.font:
-    font = TTFont(font_file)
-    missings = []
-    for c in vocab:
-        if not has_glyph(font, c):
-            missings.append(c)
+index = CoverageIndex(args.font, args.index)
+for i, font_file in enumerate(args.font):
+    missings = index.missing(i, vocab)
     if len(missings) > 0:
         if args.raw_output:
             print(font_file)
@@ -1,6 +1,7 @@
 from black_trdg import generator, samplers, transforms
 from os import makedirs, path
 from tqdm import tqdm
+from black_trdg.writers import AnnotationWriter
 import cv2
 import numpy as np
 
@@ -26,17 +27,12 @@ g = generator.Generator(
     ]),
 )
 
-annotations = []
 output_path = "outputs_easy"
 image_dir = "images"
-count = 0
 makedirs(path.join(output_path, image_dir), exist_ok=True)
-for (image, text) in tqdm(g, "Generating"):
-    count += 1
-    name = path.join(image_dir, f"{count:09d}.jpg")
-    out_path = path.join(output_path, name)
-    annotations.append(f"{out_path}\t{text}")
-    image.save(out_path)
-
-with open(path.join(output_path, "annotations.txt"), "w") as f:
-    f.write("\n".join(annotations))
+with AnnotationWriter(path.join(output_path, "annotations.txt")) as annotations:
+    for count, (image, text) in enumerate(tqdm(g, "Generating")):
+        name = path.join(image_dir, f"{count + 1:09d}.jpg")
+        out_path = path.join(output_path, name)
+        image.save(out_path)
+        annotations.write(count, f"{out_path}\t{text}")
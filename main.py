@@ -1,11 +1,11 @@
 import yaml
 import random
-from os import makedirs, path
-from traceback import print_exc
+from os import cpu_count
 from argparse import ArgumentParser
 from icecream import ic
 from black_trdg import samplers as S
-from black_trdg import transforms, generator
+from black_trdg import transforms, generator, parallel
+from black_trdg import writers
 from tqdm import tqdm
 from matplotlib import pyplot as plt
 from black_trdg import samplers
@@ -31,16 +31,51 @@ def init_from_config(
 
 def init_samplers(configs):
     ss = []
+    weights = []
     for config in configs:
+        weights.append(config.pop("weight", None))
         sampler = init_from_config(samplers, config)
         ss.append(sampler)
+    # Sources are mixed by weight if any of them has one
+    if any(weight is not None for weight in weights):
+        weights = [1 if weight is None else weight for weight in weights]
+        return samplers.MixSampler(ss, weights)
     return samplers.CombineSampler(ss)
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("config", help="Path to config file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of generating processes, 0 to use all cores")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed, same seed gives the same dataset")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume an interrupted run from its last checkpoint")
+    parser.add_argument("--checkpoint-every", type=int, default=100_000,
+                        help="Number of samples between annotation checkpoints")
+    parser.add_argument("--output-format", default="files",
+                        choices=list(writers.outputs),
+                        help="Loose image files, tar shards, tar shards per width bucket or a single packed file")
+    parser.add_argument("--shard-size", type=int, default=10000,
+                        help="Number of samples per tar shard")
+    parser.add_argument("--render-mode", default="rgba", choices=["rgba", "mask"],
+                        help="Composite an RGBA text image, or blend a text mask")
+    parser.add_argument("--color-pairing", default="sample", choices=["precompute", "sample"],
+                        help="Pick a text color per sample, or pair all backgrounds and colors up front "
+                             "(decodes and keeps every background)")
+    parser.add_argument("--palette-cache", default=None,
+                        help="File to keep the background palettes across runs")
+    parser.add_argument("--crop-contrast", type=float, default=None,
+                        help="Minimum contrast between the text color and its background crop")
+    parser.add_argument("--bucket-height", type=int, default=32,
+                        help="Height of the images, with --bucket-widths")
+    parser.add_argument("--bucket-widths", default=None,
+                        type=lambda widths: [int(w) for w in widths.split(",")],
+                        help="Comma separated image widths, every sample is resized to one of them")
     args = parser.parse_args()
+    if args.output_format == "buckets" and args.bucket_widths is None:
+        parser.error("--output-format buckets needs --bucket-widths")
 
     config = read_config(args.config)
 
@@ -66,7 +101,7 @@ def main():
     text_colors = init_samplers(config['foregrounds'])
     count = config['count']
 
-    transform = transforms.RandomApply([
+    transform = transforms.RandomGeometric([
         transforms.RandomRotate(-3, 3),
         transforms.RandomPadding((1, 10))
     ])
@@ -74,35 +109,67 @@ def main():
         transforms.GaussianNoise()
     ])
 
+    # The file output records the seed in its checkpoints,
+    # a resumed run takes it from there
+    seed = args.seed if args.seed is not None else config.get('seed')
+
+    # Generate data
+    output_path = config['output']
+    if args.output_format == "files":
+        output = writers.FileOutput(output_path,
+                                    checkpoint_every=args.checkpoint_every,
+                                    resume=args.resume,
+                                    seed=seed)
+        seed = output.seed
+    elif args.resume:
+        parser.error("--resume only works with --output-format files")
+    elif args.output_format == "tar":
+        output = writers.TarOutput(output_path, shard_size=args.shard_size)
+    elif args.output_format == "buckets":
+        output = writers.BucketedOutput(output_path, shard_size=args.shard_size)
+    else:
+        output = writers.PackedOutput(output_path)
+
     g = generator.Generator(
         texts=texts,
         backgrounds=backgrounds,
         fonts=fonts,
         text_colors=text_colors,
-        transform=lambda x: x,
-        background_transform=lambda x: x,
+        transform=None,
+        background_transform=None,
         count=count,
+        seed=seed,
+        render_mode=args.render_mode,
+        color_pairing=args.color_pairing,
+        palette_file=args.palette_cache,
+        crop_contrast=args.crop_contrast,
+        bucket_height=args.bucket_height if args.bucket_widths else None,
+        bucket_widths=args.bucket_widths,
     )
 
-    # Generate data
-    annotations = []
-    output_path = config['output']
-    image_dir = "images"
-    count = 0
-    makedirs(path.join(output_path, image_dir), exist_ok=True)
-    for (image, text) in tqdm(g, "Generating"):
-        count += 1
-        name = path.join(image_dir, f"{count:09d}.jpg")
-        out_path = path.join(output_path, name)
-        try:
-            image.save(out_path)
-            annotations.append(f"{name}\t{text}")
-        except ValueError:
-            ic(text)
-            print_exc()
-
-    with open(path.join(output_path, "annotations.txt"), "w") as f:
-        f.write("\n".join(annotations))
+    workers = args.workers or cpu_count()
+    results = parallel.generate(g, output.consume,
+                                workers=workers,
+                                start=output.start)
+    # Closed on errors and interrupts too, so that
+    # what was written so far is complete and readable
+    with output:
+        for idx, record in tqdm(results, "Generating",
+                                initial=output.start,
+                                total=len(g)):
+            output.write(idx, record)
+
+    # Palettes of the backgrounds sampled during generation
+    g.palette_index.save()
+
+    # Summed over the workers
+    if g.crop_checks > 0:
+        print(f"Crop rejection rate: {g.rejection_rate:.2%}")
+    for name, sampler in [("texts", g.texts), ("backgrounds", g.backgrounds),
+                          ("fonts", g.fonts), ("foregrounds", g.text_colors)]:
+        if isinstance(sampler, samplers.MixSampler):
+            shares = ", ".join(f"{share:.1%}" for share in sampler.shares)
+            print(f"Mix of {name}: {shares}")
 
 
 if __name__ == "__main__":